@@ -17,17 +17,17 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software Foundation,
 Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 """
-from sys import byteorder
-from array import array
-from struct import pack
+import argparse
+import queue
+import threading
 import time
-import pyaudio
-import wave
 import os
+import shutil
 import sys
 import signal
-import uuid
-import json
+
+from voxcore import (ChannelConfig, VoxChannel, VoxEngine, Finaliser, MetadataSource, Supervisor,
+                     MetricsServer, batch_segment, find_wav_files, load_channel_config, segment_file)
 
 # Version of the script
 __version__ = "2024.12.15.05"
@@ -35,14 +35,22 @@ __version__ = "2024.12.15.05"
 # Constants
 SILENCE_THRESHOLD = 2000
 RECORD_AFTER_SILENCE_SECS = 5
+AUTO_THRESHOLD = False   # follow the noise floor instead of SILENCE_THRESHOLD
+AUTO_MARGIN_DB = 12.0    # trigger this far above the noise floor in auto mode
+PREROLL_SECS = 1.0   # seconds of audio before the trigger kept in each recording
 WAVEFILES_STORAGEPATH = os.path.expanduser("~/vox-records")
-RATE = 44100
+RATE = 44100          # capture rate
+SAMPLE_RATE = None    # rate recordings are stored at, a whole fraction of RATE; None = RATE
 MAXIMUMVOL = 32767
 CHUNK_SIZE = 1024
-FORMAT = pyaudio.paInt16
+CAPTURE_CALLBACK = True   # PortAudio pushes chunks to the recorder instead of blocking reads
+FINALISE_WORKERS = 1
+FINALISE_QUEUE_DEPTH = 8   # finished recordings waiting for post-processing
+REFRESH_HZ = 10.0   # VU-meter redraws per second
 
 class suppress_stdout_stderr(object):
     def __enter__(self):
+        console.lock.acquire()   # the console thread must not write into /dev/null meanwhile
         self.outnull_file = open(os.devnull, 'w')
         self.errnull_file = open(os.devnull, 'w')
 
@@ -74,11 +82,16 @@ class suppress_stdout_stderr(object):
 
         self.outnull_file.close()
         self.errnull_file.close()
+        console.lock.release()
 
 def signal_handler(signum, frame):
     print("\nProgram interrupted by user. Exiting...")
     sys.exit(0)
 
+def log(msg):
+    """Print a message above the VU-meter line"""
+    console.log(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}")
+
 def get_metadata():
     """Retrieve metadata from radio or other source. Here, we simulate getting the frequency."""
     # In reality, this would be fetching from your radio or another source
@@ -88,187 +101,282 @@ def get_metadata():
         "notes": "Frequency and modulation are incorrect. Radio integration is not implemented."  # User-defined notes
     }
 
-def write_metadata(metadata, filename):
-    """Write metadata to a JSON file with the same base name as the audio file."""
-    json_filename = f"{filename.rsplit('.', 1)[0]}.json"
-    with open(json_filename, 'w') as json_file:
-        json.dump(metadata, json_file, indent=4)
-    print(f"Metadata saved to: {json_filename}")
-
-def show_status(snd_data, record_started, record_started_stamp, wav_filename):
-    """Displays volume levels with a VU-meter bar, threshold marker, and indicator for audio presence or recording"""
-    voice = voice_detected(snd_data)
-    status = "Audio Detected - Recording to file" if record_started else "Waiting for audio to exceed threshold"
-    
-    # Calculate simple VU level for visual feedback
-    vu_level = min(int((max(snd_data) / MAXIMUMVOL) * 30), 30)
-    vu_bar = "█" * vu_level + " " * (30 - vu_level)
-    
-    # Add a marker for the threshold
-    threshold_position = min(int((SILENCE_THRESHOLD / MAXIMUMVOL) * 30), 30)
-    vu_bar = vu_bar[:threshold_position] + '|' + vu_bar[threshold_position + 1:]
-    
-    # Audio presence or recording indicator
-    if record_started:
-        indicator = '⏺'
-    else:
-        cycle = int(time.time() * 2) % 2  # Blink every 0.5 seconds
-        indicator = '⏸' if cycle and any(abs(x) > 0 for x in snd_data) else ' '
-
-    # Print the VU meter with threshold marker, status, and indicator
-    print(f'\rVU: [{vu_bar}] | {indicator} {status}', end='')
-    if record_started:
-        elapsed = time.time() - record_started_stamp
-        print(f' | File: {os.path.basename(wav_filename)} | Time: {elapsed:.1f}s', end='')
+def vu_bar(channel, width=30):
+    """VU-meter bar of one channel with a '|' marker at the threshold"""
+    vu_level = min(int(channel.level * width), width)
+    bar = "█" * vu_level + " " * (width - vu_level)
+    threshold_position = min(int((channel.threshold / MAXIMUMVOL) * width), width)
+    return bar[:threshold_position] + '|' + bar[threshold_position + 1:]
+
+def indicator(channel):
+    """Recording indicator, or a blinking pause sign while audio is present"""
+    if channel.recording:
+        return '⏺'
+    cycle = int(time.time() * 2) % 2  # Blink every 0.5 seconds
+    return '⏸' if cycle and channel.level > 0 else ' '
+
+def show_status(channels):
+    """Displays volume levels with a VU-meter bar, threshold marker, and indicator for audio presence or recording.
+
+    The line is fitted to the terminal width: a line that wrapped would not
+    be redrawn in place. With several channels their bars shrink first.
+    """
+    columns = shutil.get_terminal_size().columns - 1   # writing the last column wraps on some terminals
+    if len(channels) == 1:
+        channel = channels[0]
+        status = "Audio Detected - Recording to file" if channel.recording else "Waiting for audio to exceed threshold"
+        line = f'VU: [{vu_bar(channel)}] | {indicator(channel)} {status}'
+        if channel.recording:
+            elapsed = time.time() - channel.rec_start
+            line += f' | File: {os.path.basename(channel.filename)} | Time: {elapsed:.1f}s'
     else:
-        print('                                                  ', end='')  # Clear previous status
-    
-    # Move cursor to the beginning of the line for next update
-    print('\r', end='')
-
-def voice_detected(snd_data):
-    """Returns 'True' if sound peaked above the 'silent' threshold"""
-    return max(snd_data) > SILENCE_THRESHOLD
-
-def normalize(snd_data):
-    """Average the volume out"""
-    max_amplitude = max(abs(i) for i in snd_data)
-    if max_amplitude == 0:
-        return snd_data  # Prevent division by zero
-    times = float(MAXIMUMVOL) / max_amplitude
-    return array('h', [int(min(MAXIMUMVOL, max(-MAXIMUMVOL, i * times))) for i in snd_data])
-
-def trim(snd_data):
-    """Trim the blank spots at the start and end"""
-    def _trim(snd_data):
-        record_started = False
-        r = array('h')
-        for i in snd_data:
-            if not record_started and abs(i) > SILENCE_THRESHOLD:
-                record_started = True
-            if record_started:
-                r.append(i)
-        return r
-
-    # Trim to the left
-    snd_data = _trim(snd_data)
-    # Trim to the right
-    snd_data.reverse()
-    snd_data = _trim(snd_data)
-    snd_data.reverse()
-    return snd_data
-
-def add_silence(snd_data, seconds):
-    """Add silence to the start and end of 'snd_data' of length 'seconds' (float)"""
-    silence = array('h', [0 for _ in range(int(seconds * RATE))])
-    return silence + snd_data + silence
-
-def wait_for_activity():
-    with suppress_stdout_stderr():
-        """Listen sound and quit when sound is detected"""
-        p = pyaudio.PyAudio()
-        stream = p.open(format=FORMAT, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK_SIZE)
-    
-    try:
-        while True:
-            snd_data = array('h', stream.read(CHUNK_SIZE))
-            if byteorder == 'big':
-                snd_data.byteswap()
-            voice = voice_detected(snd_data)
-            show_status(snd_data, False, 0, '')
-            if voice:
-                break
-    finally:
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-    return True
-
-def record_audio():
-    metadata = get_metadata()
-    with suppress_stdout_stderr():
-        """Record audio when activity is detected"""
-        p = pyaudio.PyAudio()
-        stream = p.open(format=FORMAT, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK_SIZE)
-        snd_data = array('h')
-        record_started = False
-        last_voice_stamp = 0
-        record_started_stamp = 0
-        wav_filename = ''
-
-    try:
+        # Each channel takes its label, ' [', the bar, ']', the indicator and a space
+        fixed = sum(len(ch.label) + 5 for ch in channels) - 1
+        width = max(3, min(10, (columns - fixed) // len(channels)))
+        line = ' '.join(f'{ch.label} [{vu_bar(ch, width)}]{indicator(ch)}' for ch in channels)
+    line = line[:columns].ljust(columns)  # Padding clears the previous status
+
+    # Print and move cursor to the beginning of the line for next update
+    print(f'\r{line}\r', end='', flush=True)
+
+class Console(object):
+    """Writes the log and the VU-meter line from its own thread.
+
+    Capture threads only queue their log lines and set their channels'
+    level and state, so a slow terminal (SSH, serial console) never holds
+    them up. The status line is redrawn 'refresh' times a second from the
+    channels' latest values, and not at all when 'quiet'. Until start()
+    and after stop(), log lines are printed at once.
+    """
+
+    def __init__(self, refresh=REFRESH_HZ, quiet=False):
+        self.refresh = refresh
+        self.quiet = quiet
+        self._lines = queue.SimpleQueue()
+        self._channels = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.lock = threading.Lock()   # held while writing
+
+    def log(self, line):
+        if self._thread is None:
+            self._write(line)
+        else:
+            self._lines.put(line)
+
+    def _write(self, line):
+        print(line if self.quiet else f"\r\033[K{line}", flush=True)
+
+    def start(self, channels):
+        self._channels = channels
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="console", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if not self.quiet:
+            print()
+
+    def _run(self):
         while True:
-            chunk = array('h', stream.read(CHUNK_SIZE))
-            if byteorder == 'big':
-                chunk.byteswap()
-            snd_data.extend(chunk)
-
-            voice = voice_detected(chunk)
-            show_status(chunk, record_started, record_started_stamp, wav_filename)
-
-            if voice and not record_started:
-                record_started = True
-                record_started_stamp = last_voice_stamp = time.time()
-                wav_filename = os.path.join(WAVEFILES_STORAGEPATH, f'voxrecord-{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}')
-            elif voice and record_started:
-                last_voice_stamp = time.time()
-
-            if record_started and time.time() > last_voice_stamp + RECORD_AFTER_SILENCE_SECS:
-                break
-    finally:
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-
-    # Process audio
-    snd_data = normalize(snd_data)
-    snd_data = trim(snd_data)
-    snd_data = add_silence(snd_data, 0.5)
-
-    # Save audio with wave module
-    with wave.open(f"{wav_filename}.wav", 'wb') as wf:
-        wf.setnchannels(1)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(RATE)
-        wf.writeframes(pack('<' + ('h' * len(snd_data)), *snd_data))
-
-    # Update metadata with recording times
-    metadata.update({
-        "start_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record_started_stamp)),
-        "end_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
-    })
-    endtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
-    record_time = time.time()-record_started_stamp;
-    print(f'\n{endtime} recording finished. Record duraction {record_time:.1f} seconds.')
-    write_metadata(metadata, wav_filename)
-
-    return p.get_sample_size(FORMAT), snd_data, f"{wav_filename}.wav"
-
-def voxrecord():
-    """Listen audio from the sound card. If audio is detected, record it to file. After recording,
-    start again to wait for next activity"""
+            stopping = self._stop.wait(1.0 / self.refresh)
+            with self.lock:
+                try:
+                    while True:
+                        self._write(self._lines.get_nowait())
+                except queue.Empty:
+                    pass
+                if stopping:
+                    return
+                if not self.quiet and self._channels:
+                    show_status(self._channels)
+
+console = Console()
+
+def default_channels():
+    """A single channel on the default input device, configured by the constants above"""
+    return [ChannelConfig(threshold=SILENCE_THRESHOLD, tail_silence=RECORD_AFTER_SILENCE_SECS,
+                          outdir=WAVEFILES_STORAGEPATH, preroll=PREROLL_SECS, sample_rate=SAMPLE_RATE,
+                          auto_threshold=AUTO_THRESHOLD, margin_db=AUTO_MARGIN_DB)]
+
+def serve_metrics(collect, port):
+    """Start the metrics endpoint on 127.0.0.1:port, or return None without one"""
+    if not port:
+        return None
+    server = MetricsServer(collect, port, log=log)
+    log(f"Metrics at http://{server.address[0]}:{server.address[1]}/metrics")
+    return server
+
+def voxrecord(configs, process_per_device=False, rate=RATE, metrics_port=None):
+    """Listen audio from the sound cards. If audio is detected on a channel, record it to file. After
+    recording, start again to wait for next activity"""
 
     # Register the signal handler for SIGINT (Ctrl-C)
     signal.signal(signal.SIGINT, signal_handler)
 
-    while True:
-        if not wait_for_activity():
-            break  
+    if process_per_device:
+        supervisor = Supervisor(configs, rate=rate, chunk_size=CHUNK_SIZE, callback=CAPTURE_CALLBACK,
+                                log=log, finalise_workers=FINALISE_WORKERS, meta_default=get_metadata(),
+                                metrics=bool(metrics_port))
+        server = serve_metrics(supervisor.metrics, metrics_port)
+        console.start(supervisor.channels)
         try:
-            _, _, wav_filename = record_audio()
-            print(f'Audio saved to: {wav_filename}')
-        except Exception as e:
-            print(f"Error during recording: {e}")
+            supervisor.run(threading.Event())
+        finally:
+            console.stop()
+            if server is not None:
+                server.close()
+        return
+
+    finaliser = Finaliser(workers=FINALISE_WORKERS, depth=FINALISE_QUEUE_DEPTH, log=log)
+    channels = [VoxChannel(cfg, finaliser, rate, index=i, log=log,
+                           metadata=MetadataSource(cfg.meta_script, cfg.meta_server, log=log,
+                                                   default=get_metadata()))
+                for i, cfg in enumerate(configs)]
+
+    # Each capture stream is opened once and shared by the waiting and recording
+    # states, so no audio is lost to re-initialising PyAudio between them
+    engine = VoxEngine(channels, rate=rate, chunk_size=CHUNK_SIZE, callback=CAPTURE_CALLBACK,
+                       log=log, open_context=suppress_stdout_stderr)
+    server = serve_metrics(lambda: engine.metrics() + finaliser.metrics(), metrics_port)
+    console.start(channels)
+    try:
+        engine.run(threading.Event())
+    finally:
+        console.stop()
+        if server is not None:
+            server.close()
+        finaliser.close()
+
+def ctcss_tones(value):
+    """Comma separated CTCSS tones in Hz, for --ctcss"""
+    try:
+        return [float(t) for t in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a comma separated list of tones: '{value}'")
+
+def segment(path, configs, start=None):
+    """Cut a recorded WAV file into clips, as fast as the CPU allows"""
+    finaliser = Finaliser(workers=FINALISE_WORKERS, depth=FINALISE_QUEUE_DEPTH, log=log)
+    t0 = time.time()
+    try:
+        seconds, clips = segment_file(path, configs, finaliser, log=log, start=start)
+    finally:
+        finaliser.close()
+    elapsed = max(time.time() - t0, 1e-6)
+    log(f"{path}: {seconds:.1f} s of audio in {elapsed:.1f} s "
+        f"({seconds / elapsed:.0f}x real time), {clips} clip(s)")
+
+def batch(target, configs, jobs=None, manifest=None):
+    """Cut every WAV file of a directory or glob into clips over a process pool"""
+    paths = find_wav_files(target)
+    if not paths:
+        print(f"No WAV files in {target}")
+        return
+    if manifest is None:
+        manifest = os.path.join(os.path.expanduser(configs[0].outdir), "batch-manifest.jsonl")
+    log(f"{len(paths)} file(s), progress kept in {manifest}")
+    count = 0
+    for entry, speed in batch_segment(paths, configs, manifest, jobs, log=log):
+        count += 1
+        result = f"{entry['audio_s']:.0f} s, {entry['clips']} clip(s)"
+        if "error" in entry:
+            result += f" - {entry['error']}"
+        log(f"[{count}] {os.path.basename(entry['file'])}: {result} ({speed:.0f}x real time overall)")
+
+def start_time(value):
+    """Local date and time for --start"""
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected 'YYYY-MM-DD HH:MM:SS', not '{value}'")
+
+def apply_overrides(configs, args):
+    """Command line options override the same setting of every channel"""
+    for cfg in configs:
+        if args.auto_threshold is not None:
+            cfg.auto_threshold, cfg.margin_db = True, args.auto_threshold
+        if args.ctcss:
+            cfg.ctcss = args.ctcss
+        if args.sample_rate:
+            cfg.sample_rate = args.sample_rate
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Voice activated recorder for scanner radios")
+    parser.add_argument("--config", metavar="FILE",
+                        help="JSON file describing the channels to record "
+                             "(default: one channel on the default input device)")
+    parser.add_argument("--rate", type=int, default=RATE,
+                        help=f"capture rate in Hz (default {RATE})")
+    parser.add_argument("--sample-rate", type=int, metavar="RATE",
+                        help="store recordings at this rate, a whole fraction of the capture rate "
+                             "(e.g. 48000 -> 16000 or 8000); the audio is low-pass filtered and decimated")
+    parser.add_argument("--auto-threshold", nargs="?", const=AUTO_MARGIN_DB, type=float, metavar="DB",
+                        help="trigger DB decibels above the tracked noise floor instead of at a "
+                             f"fixed threshold (default margin {AUTO_MARGIN_DB:g} dB)")
+    parser.add_argument("--ctcss", metavar="HZ[,HZ...]",
+                        type=ctcss_tones,
+                        help="record only transmissions carrying one of these CTCSS tones")
+    parser.add_argument("--from-file", metavar="WAV",
+                        help="cut an existing recording into clips instead of listening to a sound card")
+    parser.add_argument("--batch", metavar="DIR|GLOB",
+                        help="cut every WAV file in a directory (recursively) or matching a glob, "
+                             "using all CPU cores; rerunning skips files already done")
+    parser.add_argument("--jobs", type=int, metavar="N",
+                        help="worker processes for --batch (default: one per CPU core)")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="progress file of --batch (default: batch-manifest.jsonl in the output directory)")
+    parser.add_argument("--start", type=start_time, metavar="'YYYY-MM-DD HH:MM:SS'",
+                        help="wall clock time at the beginning of --from-file "
+                             "(default: file modification time minus its length)")
+    parser.add_argument("--process-per-device", action="store_true",
+                        help="capture every input device in its own worker process, "
+                             "restarted if it dies or its stream gets stuck")
+    parser.add_argument("--quiet", action="store_true",
+                        help="no VU meter, only log lines (for headless runs and log files)")
+    parser.add_argument("--refresh", type=float, default=REFRESH_HZ, metavar="HZ",
+                        help=f"VU meter redraws per second (default {REFRESH_HZ:g})")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    return parser.parse_args()
 
 if __name__ == '__main__':
+    args = parse_args()
+    console.quiet = args.quiet
+    console.refresh = max(args.refresh, 0.1)
     print(f"Voxrecorder v{__version__} started. Hit ctrl-c to quit.")
-    
-    if not os.access(WAVEFILES_STORAGEPATH, os.W_OK):
-        print(f"Wave file save directory {WAVEFILES_STORAGEPATH} does not exist or is not writable. Aborting.")
-    else:
+
+    try:
+        configs = load_channel_config(args.config) if args.config else default_channels()
+        apply_overrides(configs, args)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read channel config: {e}")
+        configs = []
+    unwritable = [cfg.outdir for cfg in configs if not os.access(os.path.expanduser(cfg.outdir), os.W_OK)]
+    if unwritable:
+        print(f"Wave file save directory {unwritable[0]} does not exist or is not writable. Aborting.")
+    elif configs and args.batch:
+        try:
+            batch(args.batch, configs, args.jobs, args.manifest)
+        except (OSError, ValueError) as e:
+            print(f"Batch failed: {e}")
+        except KeyboardInterrupt:
+            print("\nInterrupted. Run the same command again to continue.")
+    elif configs and args.from_file:
         try:
-            voxrecord()
+            segment(args.from_file, configs, args.start)
+        except (OSError, ValueError) as e:
+            print(f"Cannot process {args.from_file}: {e}")
+        except KeyboardInterrupt:
+            print("\nInterrupted.")
+    elif configs:
+        try:
+            voxrecord(configs, args.process_per_device, args.rate, args.metrics_port)
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")    
+            print(f"An unexpected error occurred: {e}")
     print("Good bye.")
-
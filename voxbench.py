@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+VOX-recorder benchmarks - time the recording pipeline on synthetic audio
+Copyright (C) 2015-2024 Kari Karvonen <oh1kk@toimii.fi>
+
+GNU GPL v3 or later.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import wave
+from array import array
+
+try:
+    import resource
+except ImportError:   # not on Windows
+    resource = None
+
+import voxcore
+
+
+def synthetic_audio(seconds, rate=voxcore.RATE, seed=1):
+    """Noise floor with a loud burst in the middle, as a scanner recording looks"""
+    rnd = random.Random(seed)
+    n = int(seconds * rate)
+    samples = array('h', (rnd.randint(-300, 300) for _ in range(n)))
+    lo, hi = n // 4, 3 * n // 4
+    samples[lo:hi] = array('h', (rnd.randint(-12000, 12000) for _ in range(hi - lo)))
+    return samples
+
+
+def _wav_bytes(samples, rate=voxcore.RATE):
+    """Serialise 'samples' as a WAV file in memory"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(voxcore.SAMPLE_WIDTH)
+        wf.setframerate(rate)
+        voxcore.write_samples(wf, samples)
+    return buf.getvalue()
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t0, result
+
+
+def bench_dsp(samples, threshold=2000, rate=voxcore.RATE):
+    """Time normalize, trim, add_silence and WAV writing.
+
+    normalize and trim are timed with and without numpy; add_silence and
+    WAV writing have no numpy path and are timed once, as "python".
+    Returns {op: {path: seconds}}"""
+    ops = [
+        ("normalize",   voxcore.normalize,   (samples,),               True),
+        ("trim",        voxcore.trim,        (samples, threshold),     True),
+        ("add_silence", voxcore.add_silence, (samples, 0.5, rate),     False),
+        ("wav_write",   _wav_bytes,          (samples, rate),          False),
+    ]
+    results = {}
+    saved = voxcore.USE_NUMPY
+    try:
+        for name, fn, args, has_numpy in ops:
+            paths = [False, True] if has_numpy and voxcore.np is not None else [False]
+            results[name] = {}
+            outputs = []
+            for use_numpy in paths:
+                voxcore.USE_NUMPY = use_numpy
+                secs, out = _timed(fn, *args)
+                results[name]["numpy" if use_numpy else "python"] = secs
+                outputs.append(out)
+            if len(outputs) == 2 and outputs[0] != outputs[1]:
+                raise AssertionError(f"{name}: numpy and python outputs differ")
+    finally:
+        voxcore.USE_NUMPY = saved
+    return results
+
+
+class _TimedSource(voxcore.SyntheticSource):
+    """SyntheticSource delivering 'chunks' chunks as fast as they are read,
+    noting when each read starts and ends"""
+
+    def __init__(self, chunks, *args, **kwargs):
+        voxcore.SyntheticSource.__init__(self, *args, realtime=False, **kwargs)
+        self.chunks = chunks
+        self.starts = []
+        self.ends = []
+
+    def read(self, timeout=None):
+        self.starts.append(time.perf_counter())
+        chunk = None
+        if len(self.ends) < self.chunks:
+            chunk = voxcore.SyntheticSource.read(self, timeout)
+        self.ends.append(time.perf_counter())
+        return chunk
+
+
+def percentile(values, pct):
+    """The 'pct' percentile of 'values', nearest rank"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def _silent(*_):
+    pass
+
+
+def bench_chunks(channels, seconds, rate=voxcore.RATE, chunk_size=voxcore.CHUNK_SIZE, outdir=None):
+    """Run a VoxEngine over 'channels' inputs of one synthetic device for
+    'seconds' of audio, as fast as it goes.
+
+    Every input gets a 2 s burst every 10 s, so channels start and stop
+    recordings and write WAV files during the run. Returns the processing
+    time of each chunk (the gap between one read returning and the next
+    starting) in seconds.
+    """
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+        configs = [voxcore.ChannelConfig(name=f"ch{i}", device="synth", input_channel=i,
+                                         tail_silence=1.0, outdir=tmp, prefix=f"ch{i:02d}")
+                   for i in range(channels)]
+        finaliser = voxcore.Finaliser(workers=2, log=_silent)
+        chans = [voxcore.VoxChannel(cfg, finaliser, rate, index=i, log=_silent)
+                 for i, cfg in enumerate(configs)]
+        sources = []
+
+        def factory(device, rate, chunk_size, width, callback):
+            sources.append(_TimedSource(int(seconds * rate / chunk_size), rate, chunk_size, width))
+            return sources[-1]
+
+        engine = voxcore.VoxEngine(chans, rate=rate, chunk_size=chunk_size, callback=False,
+                                   log=_silent, source_factory=factory)
+        try:
+            engine.run(threading.Event())
+        finally:
+            finaliser.close()
+    source = sources[0]
+    return [start - end for start, end in zip(source.starts[1:], source.ends[:-1])]
+
+
+def chunk_stats(times, rate=voxcore.RATE, chunk_size=voxcore.CHUNK_SIZE):
+    """Percentiles of per-chunk processing times, in milliseconds, against the
+    time a chunk of audio lasts"""
+    ms = [t * 1000 for t in times]
+    return {
+        "chunks":   len(ms),
+        "budget_ms": round(chunk_size / rate * 1000, 3),
+        "p50_ms":   round(percentile(ms, 50), 4),
+        "p90_ms":   round(percentile(ms, 90), 4),
+        "p99_ms":   round(percentile(ms, 99), 4),
+        "max_ms":   round(max(ms, default=0.0), 4),
+        "mean_ms":  round(sum(ms) / max(len(ms), 1), 4),
+    }
+
+
+def max_realtime_channels(seconds, limit=256, rate=voxcore.RATE, chunk_size=voxcore.CHUNK_SIZE,
+                          outdir=None):
+    """Largest channel count whose 99th percentile chunk time stays within
+    the chunk's real-time budget.
+
+    Doubles the count until a run misses the budget or reaches 'limit',
+    then bisects between the last count that kept up and the first that
+    did not. Returns (channels, {channels tried: p99 ms}).
+    """
+    budget = chunk_size / rate
+    probes = {}
+
+    def fits(n):
+        probes[n] = percentile(bench_chunks(n, seconds, rate, chunk_size, outdir), 99) * 1000
+        return probes[n] / 1000 <= budget
+
+    good, bad = 0, None
+    n = 1
+    while n <= limit:
+        if not fits(n):
+            bad = n
+            break
+        good = n
+        n *= 2
+    if bad is None:
+        if good < limit and fits(limit):
+            good = limit
+        return good, probes
+    while bad - good > 1:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    return good, probes
+
+
+def bench_finalise(lengths, rate=voxcore.RATE, outdir=None):
+    """Time VoxChannel._finalise (post-processing and JSON) on recordings of
+    each of 'lengths' seconds. Returns [{"length_s", "seconds"}]"""
+    results = []
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+        channel = voxcore.VoxChannel(voxcore.ChannelConfig(outdir=tmp), None, rate, log=_silent)
+        for length in lengths:
+            base = os.path.join(tmp, f"finalise-{length:g}")
+            with voxcore.WavStreamWriter(f"{base}.wav", rate) as writer:
+                writer.write(synthetic_audio(length, rate))
+            end = time.time()
+            secs, _ = _timed(channel._finalise, base, end - length, end, None, 0,
+                             channel.threshold, None)
+            results.append({"length_s": length, "seconds": round(secs, 4)})
+    return results
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB, or None where unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss   # bytes on macOS
+
+
+def _lengths(value):
+    try:
+        return [float(v) for v in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a comma separated list of seconds: '{value}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VOX recorder processing pipeline")
+    parser.add_argument("--seconds", type=float, default=60.0,
+                        help="length of the synthetic recording (default 60)")
+    parser.add_argument("--channels", type=int, default=4,
+                        help="channels in the capture loop run (default 4)")
+    parser.add_argument("--rate", type=int, default=voxcore.RATE,
+                        help=f"capture rate in Hz (default {voxcore.RATE})")
+    parser.add_argument("--chunk-size", type=int, default=voxcore.CHUNK_SIZE,
+                        help=f"frames per chunk (default {voxcore.CHUNK_SIZE})")
+    parser.add_argument("--finalise-lengths", type=_lengths, default=[10, 60, 300], metavar="SECS,...",
+                        help="recording lengths to time finalising (default 10,60,300)")
+    parser.add_argument("--probe-seconds", type=float, default=10.0,
+                        help="audio per run when searching the real-time channel count (default 10)")
+    parser.add_argument("--max-channels", type=int, default=256,
+                        help="stop the real-time channel search here (default 256)")
+    parser.add_argument("--outdir", default=None,
+                        help="directory for the temporary recordings (default: system temp)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results as JSON to FILE ('-' for stdout only)")
+    args = parser.parse_args()
+    out = sys.stderr if args.json == "-" else sys.stdout
+
+    def say(msg):
+        print(msg, file=out, flush=True)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {"machine": platform.machine(), "system": platform.system(),
+                     "python": platform.python_version(),
+                     "numpy": voxcore.np.__version__ if voxcore.np is not None else None},
+        "settings": {"seconds": args.seconds, "channels": args.channels, "rate": args.rate,
+                     "chunk_size": args.chunk_size},
+    }
+
+    samples = synthetic_audio(args.seconds, args.rate)
+    say(f"{len(samples)} samples ({args.seconds:.0f} s at {args.rate} Hz)")
+    if voxcore.np is None:
+        say("numpy not installed - timing the pure Python path only")
+    results["dsp"] = bench_dsp(samples, rate=args.rate)
+    for name, times in results["dsp"].items():
+        line = f"{name:12s} python {times['python']:8.3f} s"
+        if "numpy" in times:
+            speedup = times["python"] / max(times["numpy"], 1e-9)
+            line += f"   numpy {times['numpy']:8.4f} s   x{speedup:.0f}"
+        elif voxcore.np is not None:
+            line += "   (no numpy path)"
+        say(line)
+    del samples
+
+    stats = chunk_stats(bench_chunks(args.channels, args.seconds, args.rate, args.chunk_size,
+                                     args.outdir), args.rate, args.chunk_size)
+    results["capture"] = stats
+    say(f"capture loop, {args.channels} channel(s): per chunk p50 {stats['p50_ms']:.3f} ms, "
+        f"p99 {stats['p99_ms']:.3f} ms, max {stats['max_ms']:.3f} ms "
+        f"(real time allows {stats['budget_ms']:.1f} ms)")
+
+    results["finalise"] = bench_finalise(args.finalise_lengths, args.rate, args.outdir)
+    for entry in results["finalise"]:
+        say(f"finalise {entry['length_s']:6.0f} s recording: {entry['seconds']:.3f} s")
+
+    best, probes = max_realtime_channels(args.probe_seconds, args.max_channels, args.rate,
+                                         args.chunk_size, args.outdir)
+    results["realtime_channels"] = best
+    results["realtime_probes"] = {str(n): round(p99, 4) for n, p99 in sorted(probes.items())}
+    say(f"real time sustainable up to {best} channel(s) "
+        f"(p99 ms by channels: {', '.join(f'{n}: {p:.2f}' for n, p in sorted(probes.items()))})")
+
+    results["peak_rss_kb"] = peak_rss_kb()
+    if results["peak_rss_kb"] is not None:
+        say(f"peak RSS {results['peak_rss_kb'] / 1024:.1f} MiB")
+
+    if args.json == "-":
+        print(json.dumps(results, indent=2))
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        say(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
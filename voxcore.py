@@ -0,0 +1,2361 @@
+"""
+VOX-recorder core - audio capture and processing shared by the console and GUI recorders
+Copyright (C) 2015-2024 Kari Karvonen <oh1kk@toimii.fi>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+"""
+from sys import byteorder
+from bisect import bisect_left
+from operator import mul
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, fields, replace
+import glob
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import mmap
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+import os
+import queue
+import random
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import uuid
+import wave
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RATE = 44100
+CHUNK_SIZE = 1024
+MAXIMUMVOL = 32767
+SAMPLE_WIDTH = 2   # bytes per sample, paInt16
+PREROLL_SECS = 1.0
+BLOCK_SIZE = 65536   # samples per block when post-processing a file
+FINALISE_QUEUE_DEPTH = 8
+CALLBACK_QUEUE_CHUNKS = 64   # ~1.5 s of audio buffered between the callback and the reader
+STUCK_TIMEOUT = 4.0   # seconds without audio before a stream is reopened
+GAP_TOLERANCE = 0.1   # seconds of audio missing against the clock before it counts as lost
+GAP_CONFIRM = 1.0   # seconds a shortfall must last, so a late stream can catch up first
+STATUS_INTERVAL = 0.05   # seconds between status reports of a capture worker
+METRICS_INTERVAL = 1.0   # seconds between metrics reports of a capture worker
+RESTART_DELAY = 1.0   # first restart delay of a dead worker, doubled up to RESTART_DELAY_MAX
+RESTART_DELAY_MAX = 30.0
+AUTO_THRESHOLD_MIN = 200   # adaptive thresholds never drop below this
+AUTO_FLOOR_OPEN_SLOWDOWN = 30   # the noise floor follows this many times slower while open
+PEAK_HOLD_SECS = 1.0   # a channel's peak level stays this long before it decays
+PEAK_DECAY = 0.5   # full scales per second
+BATCH_STAGING = ".batch-staging-"   # per-file scratch directories of a batch, in the output directory
+
+# Block operations run vectorized when numpy is available. The pure Python
+# versions stay as the fallback and give bit-identical results.
+USE_NUMPY = np is not None
+
+
+# ── Capture ───────────────────────────────────────────────────────────────────
+
+class AudioSource(object):
+    """Where a VoxEngine gets its audio from.
+
+    open() starts the stream and returns the source. read() returns the next
+    chunk of 'chunk_size' interleaved frames of 'channels' channels as native
+    order samples, or None at the end of the stream; callback sources wait at
+    most 'timeout' seconds and return None if nothing arrived. available()
+    tells how many frames read() can return without blocking. last_delivery
+    feeds stuck detection; dropped_samples (frames lost since the source was
+    made) and overflow_events count audio that never reached read().
+    skipped_samples is the part of dropped_samples whose place in the stream
+    is known, from the stream's own timestamps or a dropped chunk; only that
+    part moves the channels' sample clocks.
+
+    CaptureEngine reads a sound card; SyntheticSource and WavFileSource stand
+    in for one where there is none.
+    """
+
+    callback = False
+
+    def __init__(self, rate=RATE, chunk_size=CHUNK_SIZE, channels=1):
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.channels = channels
+        self.last_delivery = 0.0
+        self.dropped_chunks = 0
+        self.dropped_samples = 0
+        self.skipped_samples = 0
+        self.overflow_events = 0
+        self._started = 0.0
+        self._frames = 0
+        self._gap_base = None
+        self._gap_since = None   # (time, smallest excess) of a shortfall not yet confirmed
+
+    def open(self):
+        self.last_delivery = time.time()
+        return self
+
+    def _account(self, frames, buffered=0):
+        """Count 'frames' delivered and compare the total with the clock.
+
+        A stream that keeps up has delivered, or holds in 'buffered', about
+        as many frames as time has passed since it started. The shortfall
+        is a steady latency that follows clock drift slowly. A stream that
+        is only late catches up once its backlog drains, so a jump of more
+        than GAP_TOLERANCE (or two chunks) counts as lost only if it is
+        still there GAP_CONFIRM seconds later, and then only the smallest
+        excess seen meanwhile. This is a guess from the clock, so it goes
+        to dropped_samples but not skipped_samples. Returns the frames newly
+        counted as lost.
+        """
+        now = time.time()
+        if self._gap_base is None:
+            self._started = now
+            self._frames = 0
+            self._gap_base = 0.0
+            self._gap_since = None
+            return 0
+        self._frames += frames
+        shortfall = (now - self._started) * self.rate - self._frames - buffered
+        excess = shortfall - self._gap_base
+        if excess <= max(GAP_TOLERANCE * self.rate, 2 * self.chunk_size):
+            self._gap_since = None
+            self._gap_base += 0.01 * excess   # slow: clock drift and latency changes
+            return 0
+        if self._gap_since is None:
+            self._gap_since = (now, excess)
+            return 0
+        since, smallest = self._gap_since
+        smallest = min(smallest, excess)
+        if now - since < GAP_CONFIRM:
+            self._gap_since = (since, smallest)
+            return 0
+        self._gap_since = None
+        lost = int(smallest)
+        self.dropped_samples += lost
+        self._frames += lost
+        return lost
+
+    def _skip(self, frames):
+        """Count 'frames' lost at a known place in the stream"""
+        self.dropped_samples += frames
+        self.skipped_samples += frames
+
+    def read(self, timeout=None):
+        raise NotImplementedError
+
+    def available(self):
+        return self.chunk_size
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class CaptureEngine(AudioSource):
+    """One PyAudio instance and input stream, opened once and read chunk by chunk.
+
+    Opening PyAudio costs hundreds of milliseconds on ALSA/Pulse, so the stream
+    stays open while the recorder switches between waiting and recording.
+
+    With callback=True PortAudio pushes each chunk from its own thread into a
+    bounded queue, and read() waits on that queue instead of polling the stream.
+    last_delivery is the time of the most recent callback, so a stuck stream
+    shows up as a stale timestamp. Lost input shows up as a jump in the ADC
+    time PortAudio stamps on each buffer; hosts that leave it at zero fall
+    back to the clock check in _account().
+
+    With channels > 1 every chunk holds chunk_size interleaved frames; split
+    them with deinterleave().
+    """
+
+    def __init__(self, rate=RATE, chunk_size=CHUNK_SIZE, device_index=None, callback=False,
+                 queue_chunks=CALLBACK_QUEUE_CHUNKS, channels=1):
+        AudioSource.__init__(self, rate, chunk_size, channels)
+        self.device_index = device_index
+        self.callback = callback
+        self.sample_size = SAMPLE_WIDTH
+        self._chunks = queue.Queue(maxsize=queue_chunks)
+        self._adc_next = None   # ADC time the next callback buffer should start at
+        self._pa = None
+        self._stream = None
+
+    def open(self):
+        if pyaudio is None:
+            raise RuntimeError("pyaudio is not installed")
+        self._pa = pyaudio.PyAudio()
+        kwargs = dict(format=pyaudio.paInt16, channels=self.channels, rate=self.rate,
+                      input=True, frames_per_buffer=self.chunk_size)
+        if self.device_index is not None:
+            kwargs["input_device_index"] = find_input_device(self._pa, self.device_index)
+        if self.callback:
+            kwargs["stream_callback"] = self._on_audio
+        self.last_delivery = time.time()
+        try:
+            self._stream = self._pa.open(**kwargs)
+        except Exception:
+            self._pa.terminate()
+            self._pa = None
+            raise
+        self.sample_size = self._pa.get_sample_size(pyaudio.paInt16)
+        self._gap_base = None   # loss accounting starts with the first chunk
+        self._adc_next = None
+        if self.callback:
+            self._stream.start_stream()
+        return self
+
+    def _on_audio(self, in_data, frame_count, time_info, status):
+        chunk = array('h', in_data)
+        if byteorder == 'big':
+            chunk.byteswap()
+        self.last_delivery = time.time()
+        if status & pyaudio.paInputOverflow:
+            self.overflow_events += 1
+        adc = (time_info or {}).get("input_buffer_adc_time", 0.0)
+        if adc > 0:
+            if self._adc_next is not None:
+                gap = int(round((adc - self._adc_next) * self.rate))
+                if gap > self.chunk_size // 2:
+                    self._skip(gap)
+            self._adc_next = adc + frame_count / self.rate
+        else:
+            self._account(frame_count)
+        try:
+            self._chunks.put_nowait(chunk)
+        except queue.Full:
+            self.dropped_chunks += 1
+            self._skip(frame_count)
+        return (None, pyaudio.paContinue)
+
+    def read(self, timeout=None):
+        """Return the next chunk as native-order samples.
+
+        Blocking mode waits inside PortAudio, which does not report
+        overflows there, so lost audio is found by comparing the frames read
+        and still buffered with the clock. Callback mode waits on the queue
+        for at most 'timeout' seconds and returns None if nothing arrived.
+        """
+        if self.callback:
+            try:
+                return self._chunks.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        chunk = array('h', self._stream.read(self.chunk_size, exception_on_overflow=False))
+        if byteorder == 'big':
+            chunk.byteswap()
+        self.last_delivery = time.time()
+        if self._account(self.chunk_size, self._stream.get_read_available()):
+            self.overflow_events += 1
+        return chunk
+
+    def available(self):
+        """Frames that can be read without blocking"""
+        if self.callback:
+            return self._chunks.qsize() * self.chunk_size
+        return self._stream.get_read_available()
+
+    def close(self):
+        try:
+            if self._stream is not None:
+                self._stream.stop_stream()
+                self._stream.close()
+        finally:
+            self._stream = None
+            if self._pa is not None:
+                self._pa.terminate()
+                self._pa = None
+
+
+def deinterleave(chunk, channels):
+    """Split an interleaved chunk into one array per input channel.
+
+    Extended slicing of an array copies in C, so this costs no Python-level
+    loop over the samples.
+    """
+    if channels == 1:
+        return [chunk]
+    return [chunk[i::channels] for i in range(channels)]
+
+
+def find_input_device(pa, device):
+    """Resolve 'device' to a PyAudio device index. A string matches the first input
+    device whose name contains it; an int is used as is."""
+    if not isinstance(device, str):
+        return device
+    if device.isdigit():
+        return int(device)
+    for i in range(pa.get_device_count()):
+        info = pa.get_device_info_by_index(i)
+        if info.get("maxInputChannels", 0) > 0 and device.lower() in info["name"].lower():
+            return i
+    raise RuntimeError(f"No input device matching '{device}'")
+
+
+def read_chunk_with_stuck_detect(engine, stop_event, stuck_timeout=STUCK_TIMEOUT):
+    """Read one chunk from 'engine', or return None once 'stop_event' is set.
+
+    Raises RuntimeError if the stream appears stuck (no data delivered within
+    'stuck_timeout' seconds). In callback mode this waits on the engine's queue;
+    otherwise it falls back to a short-timeout poll so stop_event is still seen.
+    """
+    if engine.callback:
+        while not stop_event.is_set():
+            chunk = engine.read(timeout=0.1)
+            if chunk is not None:
+                return chunk
+            if time.time() - engine.last_delivery > stuck_timeout:
+                raise RuntimeError("Audio stream stuck – no data received")
+        return None
+    deadline = time.time() + stuck_timeout
+    while time.time() < deadline:
+        if stop_event.is_set():
+            return None
+        if engine.available() >= engine.chunk_size:
+            return engine.read()
+        time.sleep(0.02)
+    raise RuntimeError("Audio stream stuck – no data received")
+
+
+# ── Pre-trigger ring buffer ───────────────────────────────────────────────────
+
+class PreRoll(object):
+    """Ring buffer holding the last 'seconds' of idle audio.
+
+    The storage is allocated once; pushing a chunk copies it into place without
+    creating new arrays, so keeping the ring armed while the channel idles for
+    hours costs no memory growth. Only drain() allocates, once per trigger.
+    """
+
+    def __init__(self, seconds=PREROLL_SECS, rate=RATE):
+        self.size = max(0, int(seconds * rate))
+        self._buf = array('h', bytes(self.size * SAMPLE_WIDTH))
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        self._filled = 0
+
+    def push(self, chunk):
+        size = self.size
+        n = len(chunk)
+        if size == 0 or n == 0:
+            return
+        src = memoryview(chunk)
+        if n >= size:
+            self._view[:] = src[n - size:]
+            self._pos = 0
+            self._filled = size
+            return
+        end = self._pos + n
+        if end <= size:
+            self._view[self._pos:end] = src
+        else:
+            first = size - self._pos
+            self._view[self._pos:] = src[:first]
+            self._view[:n - first] = src[first:]
+        self._pos = end % size
+        self._filled = min(size, self._filled + n)
+
+    def drain(self):
+        """Return the buffered samples in chronological order and empty the ring"""
+        if self._filled < self.size:
+            samples = self._buf[self._pos - self._filled:self._pos]
+        else:
+            samples = self._buf[self._pos:] + self._buf[:self._pos]
+        self.clear()
+        return samples
+
+    def clear(self):
+        self._pos = 0
+        self._filled = 0
+
+    def __len__(self):
+        return self._filled
+
+
+# ── Sample block operations ───────────────────────────────────────────────────
+
+def _as_np(samples):
+    return np.frombuffer(samples, dtype=np.int16)
+
+def _from_np(values):
+    out = array('h')
+    out.frombytes(memoryview(values.astype(np.int16)).cast('B'))
+    return out
+
+def peak(samples):
+    """Largest absolute sample value"""
+    if USE_NUMPY:
+        if not len(samples):
+            return 0
+        x = _as_np(samples)
+        return max(int(x.max()), -int(x.min()))
+    return max((abs(i) for i in samples), default=0)
+
+def scale(samples, times):
+    """Multiply samples by 'times', clipped to +-MAXIMUMVOL"""
+    if USE_NUMPY:
+        # astype() truncates toward zero like int() does
+        return _from_np(np.clip(_as_np(samples) * float(times), -MAXIMUMVOL, MAXIMUMVOL))
+    return array('h', [int(min(MAXIMUMVOL, max(-MAXIMUMVOL, i * times))) for i in samples])
+
+def _above(samples, threshold):
+    x = _as_np(samples)
+    return (x > threshold) | (x < -threshold)
+
+def first_above(samples, threshold):
+    """Index of the first sample whose magnitude exceeds 'threshold', or -1"""
+    if USE_NUMPY:
+        if not len(samples) or threshold >= 32768:
+            return -1
+        mask = _above(samples, threshold)
+        i = int(mask.argmax())
+        return i if mask[i] else -1
+    return next((i for i, x in enumerate(samples) if abs(x) > threshold), -1)
+
+def last_above(samples, threshold):
+    """Index of the last sample whose magnitude exceeds 'threshold', or -1"""
+    if USE_NUMPY:
+        if not len(samples) or threshold >= 32768:
+            return -1
+        mask = _above(samples, threshold)[::-1]
+        i = int(mask.argmax())
+        return len(samples) - 1 - i if mask[i] else -1
+    return next((i for i in range(len(samples) - 1, -1, -1) if abs(samples[i]) > threshold), -1)
+
+def silence(count):
+    return array('h', bytes(count * SAMPLE_WIDTH))
+
+def normalize(samples):
+    """Scale the loudest sample to MAXIMUMVOL"""
+    mx = peak(samples)
+    if mx == 0:
+        return samples
+    return scale(samples, float(MAXIMUMVOL) / mx)
+
+def trim(samples, threshold, lead=0):
+    """Cut leading/trailing samples below 'threshold', keeping 'lead' samples before the first sound"""
+    start = first_above(samples, threshold)
+    if start < 0:
+        return array('h')
+    end = last_above(samples, threshold)
+    return samples[max(0, start - lead):end + 1]
+
+def add_silence(samples, seconds, rate=RATE):
+    """Add 'seconds' of silence to the start and end of 'samples'"""
+    pad = silence(int(seconds * rate))
+    return pad + samples + pad
+
+
+# ── Decimation ────────────────────────────────────────────────────────────────
+
+def decimation_factor(capture_rate, rate):
+    """Integer factor from 'capture_rate' down to 'rate'; ValueError if there is none"""
+    if not rate or rate > capture_rate or capture_rate % rate:
+        raise ValueError(f"Cannot store {capture_rate} Hz capture at {rate} Hz: "
+                         f"the capture rate must be a whole multiple of the storage rate")
+    return capture_rate // rate
+
+
+class Decimator(object):
+    """Low-pass FIR filter and integer-factor downsampler, fed chunk by chunk.
+
+    The filter is a Hamming-windowed sinc cutting off at 90% of the output
+    Nyquist frequency, with 'taps_per_phase' taps for each of the 'factor'
+    polyphase branches. Only the kept output samples are computed, and the
+    filter history and output phase carry over between chunks, so chunk
+    boundaries leave no trace in the output.
+    """
+
+    def __init__(self, factor, taps_per_phase=16):
+        self.factor = factor
+        n = factor * taps_per_phase + 1
+        fc = 0.45 / factor   # cutoff in cycles per input sample
+        mid = (n - 1) / 2
+        taps = []
+        for i in range(n):
+            t = i - mid
+            sinc = 2 * fc if t == 0 else math.sin(2 * math.pi * fc * t) / (math.pi * t)
+            taps.append(sinc * (0.54 - 0.46 * math.cos(2 * math.pi * i / (n - 1))))
+        gain = sum(taps)
+        self.taps = [t / gain for t in taps]   # symmetric, so no reversal is needed
+        self._hist = array('h', bytes((n - 1) * SAMPLE_WIDTH))
+        self._phase = 0   # start of the next output's window in hist + chunk
+        if USE_NUMPY:
+            self._np_taps = np.array(self.taps)
+
+    def __call__(self, chunk):
+        """Filter one chunk; returns the decimated samples (about len(chunk) / factor)"""
+        buf = self._hist + chunk
+        n = len(self.taps)
+        count = max(0, (len(buf) - n - self._phase) // self.factor + 1)
+        if USE_NUMPY:
+            x = _as_np(buf).astype(np.float64)
+            windows = np.lib.stride_tricks.sliding_window_view(x, n)
+            y = windows[self._phase:self._phase + count * self.factor:self.factor] @ self._np_taps
+            out = _from_np(np.clip(np.rint(y), -MAXIMUMVOL - 1, MAXIMUMVOL))
+        else:
+            taps = self.taps
+            out = array('h')
+            for k in range(count):
+                p = self._phase + k * self.factor
+                v = round(sum(map(mul, buf[p:p + n], taps)))
+                out.append(min(MAXIMUMVOL, max(-MAXIMUMVOL - 1, v)))
+        keep = len(buf) - (n - 1)
+        self._phase = self._phase + count * self.factor - keep
+        self._hist = buf[keep:]
+        return out
+
+
+# ── WAV files ─────────────────────────────────────────────────────────────────
+
+def write_samples(wf, samples, patch_header=True):
+    """Write native-order 16-bit samples to an open wave writer.
+
+    The sample buffer goes to wave.writeframes() through the buffer protocol,
+    without packing it into a new bytes object. wave converts to little-endian
+    itself, so the data is only byteswapped on big-endian hosts.
+    """
+    data = memoryview(samples).cast('B')
+    if patch_header:
+        wf.writeframes(data)
+    else:
+        wf.writeframesraw(data)
+
+
+class WavStreamWriter(object):
+    """Mono 16-bit WAV that grows chunk by chunk while a transmission is recorded.
+
+    Frames go to disk as they arrive, so memory stays flat however long the
+    carrier is up. The RIFF sizes are patched at close(), and about once a
+    second in between, so a crash still leaves a readable file.
+    """
+
+    def __init__(self, path, rate=RATE, patch_secs=1.0):
+        self.path = path
+        self.rate = rate
+        self.frames = 0
+        self._patch_every = max(1, int(patch_secs * rate))
+        self._unpatched = 0
+        self._wf = wave.open(path, 'wb')
+        self._wf.setnchannels(1)
+        self._wf.setsampwidth(SAMPLE_WIDTH)
+        self._wf.setframerate(rate)
+
+    def write(self, samples):
+        self.frames += len(samples)
+        self._unpatched += len(samples)
+        patch = self._unpatched >= self._patch_every
+        if patch:
+            self._unpatched = 0
+        write_samples(self._wf, samples, patch_header=patch)
+
+    def close(self):
+        if self._wf is not None:
+            self._wf.close()
+            self._wf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _flac_command(src, dst, bitrate):
+    return ["flac", "--silent", "--best", "--force", "-o", dst, src]
+
+def _opus_command(src, dst, bitrate):
+    return ["opusenc", "--quiet", "--bitrate", str(bitrate), src, dst]
+
+# format -> (encoder program, command builder)
+ENCODERS = {
+    "flac": ("flac", _flac_command),
+    "opus": ("opusenc", _opus_command),
+}
+FORMATS = ("wav",) + tuple(ENCODERS)
+
+
+def check_encoder(fmt):
+    """Raise ValueError if recordings cannot be stored in 'fmt' on this machine"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}' (choose from {', '.join(FORMATS)})")
+    if fmt in ENCODERS and shutil.which(ENCODERS[fmt][0]) is None:
+        raise ValueError(f"Format '{fmt}' needs the '{ENCODERS[fmt][0]}' encoder; "
+                         f"install it (e.g. sudo apt install {ENCODERS[fmt][0].replace('enc', '-tools')})")
+
+
+def encode_wav(wav_path, fmt, bitrate=24):
+    """Encode a finished WAV with the format's command line encoder.
+
+    The encoder runs as its own process and writes to a temporary file,
+    which replaces the final name atomically; the WAV is removed only after
+    that. Returns (output path, WAV size / output size).
+    """
+    program, command = ENCODERS[fmt]
+    out_path = f"{os.path.splitext(wav_path)[0]}.{fmt}"
+    tmp_path = out_path + ".tmp"
+    result = subprocess.run(command(wav_path, tmp_path, bitrate),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not os.path.exists(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        error = result.stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(f"{program} failed ({result.returncode})" +
+                           (f": {error[-1]}" if error else ""))
+    ratio = os.path.getsize(wav_path) / max(os.path.getsize(tmp_path), 1)
+    os.replace(tmp_path, out_path)
+    os.remove(wav_path)
+    return out_path, ratio
+
+
+def read_blocks(path, block=BLOCK_SIZE):
+    """Yield the samples of a mono 16-bit WAV file as native-order arrays of at most 'block' samples"""
+    with wave.open(path, 'rb') as wf:
+        while True:
+            data = wf.readframes(block)
+            if not data:
+                break
+            yield array('h', data)
+
+
+def postprocess_wav(path, normalize=True, trim_threshold=None, lead=0, pad_secs=0.0, block=BLOCK_SIZE):
+    """Normalize, trim and pad a recorded WAV file in place.
+
+    The file is read in blocks, so memory use does not depend on the recording
+    length. The result is identical to running normalize(), trim() and
+    add_silence() on the whole recording in that order.
+    """
+    if not normalize and trim_threshold is None and pad_secs <= 0:
+        return
+    with wave.open(path, 'rb') as wf:
+        rate = wf.getframerate()
+        total = wf.getnframes()
+
+    times = None
+    if normalize:
+        mx = 0
+        for samples in read_blocks(path, block):
+            mx = max(mx, peak(samples))
+        if mx:
+            times = float(MAXIMUMVOL) / mx
+
+    start, end = 0, total
+    if trim_threshold is not None:
+        start, end, offset = -1, -1, 0
+        for samples in read_blocks(path, block):
+            if times is not None:
+                samples = scale(samples, times)
+            if start < 0:
+                i = first_above(samples, trim_threshold)
+                if i >= 0:
+                    start = offset + i
+            i = last_above(samples, trim_threshold)
+            if i >= 0:
+                end = offset + i
+            offset += len(samples)
+        if start < 0:
+            start, end = 0, 0
+        else:
+            start, end = max(0, start - lead), end + 1
+
+    pad = int(pad_secs * rate) if pad_secs > 0 else 0
+    tmp_path = f"{path}.tmp"
+    with WavStreamWriter(tmp_path, rate) as out:
+        for i in range(0, pad, block):
+            out.write(silence(min(block, pad - i)))
+        offset = 0
+        for samples in read_blocks(path, block):
+            lo, hi = max(start - offset, 0), min(end - offset, len(samples))
+            offset += len(samples)
+            if lo >= hi:
+                continue
+            if lo > 0 or hi < len(samples):
+                samples = samples[lo:hi]
+            if times is not None:
+                samples = scale(samples, times)
+            out.write(samples)
+        for i in range(0, pad, block):
+            out.write(silence(min(block, pad - i)))
+    os.replace(tmp_path, path)
+
+
+# ── Metrics ───────────────────────────────────────────────────────────────────
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DURATION_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+FINALISE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_FAMILIES = {
+    "vox_chunk_read_seconds":    ("histogram", "Time to get one chunk from the audio source"),
+    "vox_stream_restarts_total": ("counter",   "Audio streams reopened after getting stuck"),
+    "vox_worker_restarts_total": ("counter",   "Capture worker processes restarted"),
+    "vox_triggers_total":        ("counter",   "Recordings started by the VOX"),
+    "vox_recording":             ("gauge",     "1 while the channel is recording"),
+    "vox_recording_seconds":     ("histogram", "Length of finished recordings"),
+    "vox_written_bytes_total":   ("counter",   "Bytes of finished audio files"),
+    "vox_dropped_samples_total": ("counter",   "Samples lost before reaching the channel"),
+    "vox_overflow_events_total": ("counter",   "Input overflows and gaps seen by the channel"),
+    "vox_finalise_queue_depth":  ("gauge",     "Recordings waiting to be finalised"),
+    "vox_finalise_seconds":      ("histogram", "Time to post-process a recording and write its JSON"),
+}
+
+
+class Histogram(object):
+    """Histogram with fixed buckets, in the Prometheus sense.
+
+    Counts and sum live in preallocated arrays, so observe() keeps no new
+    objects and can sit in the per-chunk path.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = array('Q', bytes(8 * (len(self.buckets) + 1)))   # last: above all buckets
+        self.total = array('d', [0.0])
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total[0] += value
+
+    def rows(self, name, labels=()):
+        """Cumulative bucket, sum and count rows of 'name'"""
+        rows = []
+        count = 0
+        for bound, n in zip(self.buckets + (math.inf,), self.counts):
+            count += n
+            le = "+Inf" if bound == math.inf else f"{bound:g}"
+            rows.append((f"{name}_bucket", labels + (("le", le),), count))
+        rows.append((f"{name}_sum", labels, self.total[0]))
+        rows.append((f"{name}_count", labels, count))
+        return rows
+
+
+def device_label(device):
+    return "default" if device is None else str(device)
+
+
+def _family(name):
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRIC_FAMILIES:
+            return name[:-len(suffix)]
+    return name
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(rows):
+    """Prometheus text format of metric rows, (name, ((label, value), ...), value)"""
+    families = {}
+    for row in rows:
+        families.setdefault(_family(row[0]), []).append(row)
+    lines = []
+    for family, items in families.items():
+        kind, text = METRIC_FAMILIES.get(family, ("untyped", ""))
+        lines.append(f"# HELP {family} {text}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in items:
+            if labels:
+                name += "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in labels) + "}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """Serves the rows returned by 'collect' at http://HOST:PORT/metrics.
+
+    Runs on a daemon thread and only binds to 127.0.0.1 by default, so
+    the numbers stay on the machine unless a local scraper or tunnel
+    passes them on. collect() runs on the server thread at scrape time.
+    """
+
+    def __init__(self, collect, port, host="127.0.0.1", log=print):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = render_metrics(collect()).encode()
+                except Exception as e:
+                    log(f"Metrics collection failed: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ── Background finalisation ───────────────────────────────────────────────────
+
+class Finaliser(object):
+    """Bounded job queue served by worker threads.
+
+    Post-processing and writing the metadata of a finished recording run here,
+    so the capture thread goes straight back to reading the stream. If the queue
+    is full, submit() blocks until a worker frees a slot, so a job is never
+    dropped. A job that raises is logged, counted in 'failures' and passed
+    to on_error(name, error).
+    """
+
+    def __init__(self, workers=1, depth=FINALISE_QUEUE_DEPTH, log=print, on_error=None):
+        self._queue = queue.Queue(maxsize=depth)
+        self._log = log
+        self._on_error = on_error
+        self.failures = 0
+        self.times = Histogram(FINALISE_BUCKETS)
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"finalise-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, name, fn, *args):
+        """Queue fn(*args); 'name' identifies the job in the log"""
+        if self._queue.full():
+            self._log(f"Finalise queue full ({self._queue.maxsize}) - waiting for a free slot")
+        self._queue.put((name, fn, args, time.time()))
+        self._log(f"Finalise queued: {name} (queue depth {self._queue.qsize()})")
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def metrics(self):
+        return [("vox_finalise_queue_depth", (), self.depth())] + self.times.rows("vox_finalise_seconds")
+
+    def close(self, wait=True):
+        """Stop the workers once the queued jobs are done"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            name, fn, args, queued_at = job
+            started = time.time()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.failures += 1
+                self._log(f"Finalise failed: {name}: {e}")
+                if self._on_error:
+                    self._on_error(name, e)
+                continue
+            done = time.time()
+            self.times.observe(done - started)
+            self._log(f"Finalised {name} in {done - started:.2f}s "
+                      f"(waited {started - queued_at:.2f}s, queue depth {self._queue.qsize()})")
+
+
+# ── Metadata script ───────────────────────────────────────────────────────────
+
+class MetadataSource(object):
+    """Runs the user's metadata script without holding up audio capture.
+
+    fetch() returns a Future at once, and the session reads its result when it
+    is finalised. In one-shot mode the script runs on a worker thread for each
+    fetch. In server mode it is started once and prints one JSON object per line
+    whenever the radio state changes, so fetch() just hands out the latest line.
+    If the script fails or times out, the last good result is used instead.
+    """
+
+    def __init__(self, script, server=False, timeout=5.0, log=print, default=None):
+        self.script = script
+        self.default = default or {}
+        self.server = server
+        self.timeout = timeout
+        self._log = log
+        self._cached = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._proc = None
+        self._reader = None
+        if not script:
+            return
+        if server:
+            self._start_server()
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata")
+
+    def fetch(self):
+        """Start collecting metadata for a session; returns a Future of a dict"""
+        if not self.script:
+            future = Future()
+            future.set_result(dict(self.default))
+            return future
+        if self.server:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start_server()
+            future = Future()
+            future.set_result(self._latest())
+            return future
+        return self._pool.submit(self._run_once)
+
+    def get(self):
+        """Fetch and wait for the result"""
+        return self.fetch().result()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+
+    def _latest(self):
+        with self._lock:
+            return dict(self._cached)
+
+    def _store(self, meta):
+        with self._lock:
+            self._cached = meta
+
+    def _run_once(self):
+        try:
+            result = subprocess.run([self.script], capture_output=True, text=True,
+                                    timeout=self.timeout)
+            raw = result.stdout.strip()
+            if raw:
+                meta = json.loads(raw)
+                self._store(meta)
+                return dict(meta)
+        except Exception as e:
+            self._log(f"Metadata script error: {e}")
+        return self._latest()
+
+    def _start_server(self):
+        try:
+            self._proc = subprocess.Popen([self.script], stdout=subprocess.PIPE,
+                                          stdin=subprocess.DEVNULL, text=True, bufsize=1)
+        except Exception as e:
+            self._log(f"Metadata server error: {e}")
+            self._proc = None
+            return
+        self._reader = threading.Thread(target=self._read_server, args=(self._proc,),
+                                        name="metadata-server", daemon=True)
+        self._reader.start()
+
+    def _read_server(self, proc):
+        for line in proc.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self._store(json.loads(line))
+            except ValueError as e:
+                self._log(f"Metadata server sent bad JSON: {e}")
+        self._log(f"Metadata server exited (code {proc.wait()})")
+
+
+# ── Channels ──────────────────────────────────────────────────────────────────
+
+class SampleClock(object):
+    """Time derived from the number of samples processed since 'start'.
+
+    Used in place of the wall clock when audio is not arriving in real time,
+    such as when a file is processed faster than real time.
+    """
+
+    def __init__(self, start, rate=RATE):
+        self.start = start
+        self.rate = rate
+        self.samples = 0
+
+    def advance(self, samples):
+        self.samples += samples
+
+    def now(self):
+        return self.start + self.samples / self.rate
+
+
+def make_filename(outdir, prefix="voxrecord", when=None):
+    """Recording path without extension: <outdir>/<prefix>-<timestamp>-<uid>"""
+    ts = time.strftime("%Y%m%d%H%M%S", time.localtime(when))
+    return os.path.join(os.path.expanduser(outdir), f"{prefix or 'voxrecord'}-{ts}-{uuid.uuid4().hex[:8]}")
+
+
+# ── Voice detectors ───────────────────────────────────────────────────────────
+
+class Detector(object):
+    """Decides chunk by chunk whether a channel hears a signal.
+
+    Subclasses define level(), a loudness in sample units compared against
+    the channel's thresholds. The detector opens when the level exceeds
+    'threshold' and, once open, stays open while it exceeds 'close_threshold'
+    (hysteresis; the same as 'threshold' when unset). With 'min_open' set,
+    the level must stay up for that many seconds before the detector opens,
+    so a single click does not start a recording. Settings are read from the
+    channel config on every chunk, so changes apply at once.
+
+    With 'auto_threshold' the detector tracks the noise floor instead: an
+    exponential average of the level of idle chunks, with a time constant of
+    'floor_time' seconds, that falls four times faster than it rises so a
+    weak signal below the threshold does not drag it up. While the detector
+    is open the floor keeps following, AUTO_FLOOR_OPEN_SLOWDOWN times
+    slower, so a transmission hardly moves it but a lasting rise of the
+    noise by more than the margin still closes the detector in the end.
+    The threshold is then the floor plus 'margin_db', and a close threshold
+    keeps its ratio to the configured one. 'threshold' always holds the
+    level in use.
+    """
+
+    def __init__(self, config, rate=RATE):
+        self.config = config
+        self.rate = rate
+        self.open = False
+        self.floor = None   # noise floor estimate, auto mode only
+        self.threshold = config.threshold
+        self._run = 0   # samples the level has stayed up
+
+    def level(self, chunk):
+        raise NotImplementedError
+
+    def __call__(self, chunk, level=None):
+        """Feed one chunk; True while the detector is open. 'level' may pass
+        in level(chunk) when the caller already computed it."""
+        cfg = self.config
+        if level is None:
+            level = self.level(chunk)
+        if cfg.auto_threshold:
+            self._track_floor(level, len(chunk))
+            self.threshold = max(self.floor * 10 ** (cfg.margin_db / 20), AUTO_THRESHOLD_MIN)
+        else:
+            self.threshold = cfg.threshold
+        if cfg.close_threshold is None:
+            close = self.threshold
+        else:
+            close = self.threshold * cfg.close_threshold / cfg.threshold
+        if level > (close if self.open else self.threshold):
+            self._run += len(chunk)
+        else:
+            self._run = 0
+        self.open = self._run > 0 and self._run >= cfg.min_open * self.rate
+        return self.open
+
+    def _track_floor(self, level, samples):
+        if self.floor is None:
+            self.floor = float(level)
+            return
+        alpha = min(samples / (self.config.floor_time * self.rate), 1.0)
+        if self.open:
+            alpha /= AUTO_FLOOR_OPEN_SLOWDOWN
+        if level > self.floor:
+            alpha /= 4
+        self.floor += alpha * (level - self.floor)
+
+    def reset(self):
+        self.open = False
+        self._run = 0
+
+
+class PeakDetector(Detector):
+    """Highest sample of the chunk, the recorder's original trigger"""
+
+    def level(self, chunk):
+        if not len(chunk):
+            return 0
+        if USE_NUMPY:
+            return int(_as_np(chunk).max())
+        return max(chunk)
+
+
+class RMSDetector(Detector):
+    """Root mean square of the chunk. Follows the energy of both half-waves,
+    so short clicks and a DC offset barely move it."""
+
+    def level(self, chunk):
+        n = len(chunk)
+        if not n:
+            return 0.0
+        if USE_NUMPY:
+            x = _as_np(chunk).astype(np.float64)
+            return math.sqrt(float(np.dot(x, x)) / n)
+        return math.sqrt(sum(map(mul, chunk, chunk)) / n)
+
+
+DETECTORS = {
+    "peak": PeakDetector,
+    "rms":  RMSDetector,
+}
+
+
+def make_detector(config, rate=RATE):
+    """The detector named by config.detector, bound to 'config'"""
+    return DETECTORS[config.detector](config, rate)
+
+
+class ToneSquelch(object):
+    """CTCSS tone gate: one Goertzel filter per configured tone.
+
+    The filters run over consecutive windows of 'window' seconds, carried
+    across chunk boundaries; half a second resolves tones about 2 Hz apart,
+    as the CTCSS table needs. At the end of each window the strongest tone
+    is taken if it holds at least 'min_ratio' of the window's energy, and
+    'tone' keeps that result until the next window ends. With numpy the
+    filters are one matrix-vector product per chunk against a table of the
+    tones' complex exponentials over one chunk, turned to the chunk's place
+    in the window by one phasor per tone, so the table grows with the
+    chunk size rather than the window.
+    """
+
+    def __init__(self, tones, rate=RATE, window=0.5, min_ratio=0.05):
+        self.tones = [float(t) for t in tones]
+        self.rate = rate
+        self.size = max(int(window * rate), 1)
+        self.min_ratio = min_ratio
+        self.tone = None
+        self._coeffs = [2 * math.cos(2 * math.pi * f / rate) for f in self.tones]
+        self._numpy = USE_NUMPY
+        if self._numpy:
+            self._omega = 2 * np.pi * np.array(self.tones) / rate
+            self._basis = np.zeros((len(self.tones), 0), dtype=np.complex128)   # grown to the chunk size
+        self.reset()
+
+    def reset(self):
+        self.tone = None
+        self._pos = 0
+        self._energy = 0.0
+        if self._numpy:
+            self._acc = np.zeros(len(self.tones), dtype=np.complex128)
+        else:
+            self._state = [[0.0, 0.0] for _ in self.tones]   # Goertzel s[n-1], s[n-2]
+
+    def __call__(self, chunk):
+        """Feed one chunk; returns the tone heard in the last complete window, or None"""
+        i = 0
+        while i < len(chunk):
+            take = min(len(chunk) - i, self.size - self._pos)
+            self._accumulate(chunk[i:i + take])
+            self._pos += take
+            i += take
+            if self._pos == self.size:
+                self._decide()
+        return self.tone
+
+    def _accumulate(self, part):
+        if self._numpy:
+            x = _as_np(part).astype(np.float64)
+            if len(x) > self._basis.shape[1]:
+                self._basis = np.exp(-1j * np.outer(self._omega, np.arange(len(x))))
+            phasor = np.exp(-1j * self._omega * self._pos)
+            self._acc += phasor * (self._basis[:, :len(x)] @ x)
+            self._energy += float(np.dot(x, x))
+            return
+        for state, coeff in zip(self._state, self._coeffs):
+            s1, s2 = state
+            for x in part:
+                s1, s2 = x + coeff * s1 - s2, s1
+            state[0], state[1] = s1, s2
+        self._energy += sum(map(mul, part, part))
+
+    def _decide(self):
+        if self._numpy:
+            powers = list(np.abs(self._acc) ** 2)
+        else:
+            powers = [s1 * s1 + s2 * s2 - coeff * s1 * s2
+                      for (s1, s2), coeff in zip(self._state, self._coeffs)]
+        energy = self._energy
+        # A pure tone of the window holds 2 * |X|^2 / (N * energy) = 1 of its energy
+        ratios = [2 * p / (self.size * energy) if energy else 0.0 for p in powers]
+        best = max(range(len(ratios)), key=ratios.__getitem__)
+        tone = self.tones[best] if ratios[best] >= self.min_ratio else None
+        self.reset()
+        self.tone = tone
+
+
+def make_squelch(config, rate=RATE):
+    """ToneSquelch for the channel's CTCSS tones, or None without tones"""
+    if not config.ctcss:
+        return None
+    return ToneSquelch(config.ctcss, rate, config.ctcss_window, config.ctcss_ratio)
+
+
+@dataclass
+class ChannelConfig:
+    """Settings of one VOX channel. 'device' is a PyAudio device index, a device
+    name substring, or None for the default input device. 'input_channel' picks
+    one channel of a multichannel device (0 = left, 1 = right, ...).
+    'sample_rate' is the rate recordings are stored at, a whole fraction of
+    the capture rate; None stores at the capture rate."""
+    name: str = ""
+    device: object = None
+    input_channel: int = 0
+    sample_rate: int = None
+    threshold: float = 2000
+    tail_silence: float = 5.0
+    detector: str = "peak"
+    close_threshold: float = None
+    min_open: float = 0.0
+    auto_threshold: bool = False
+    margin_db: float = 12.0
+    floor_time: float = 10.0
+    ctcss: list = None
+    ctcss_window: float = 0.5
+    ctcss_ratio: float = 0.05
+    format: str = "wav"
+    opus_bitrate: int = 24   # kbit/s
+    prefix: str = "voxrecord"
+    outdir: str = "~/vox-records"
+    meta_script: str = ""
+    meta_server: bool = False
+    preroll: float = PREROLL_SECS
+    normalize: bool = True
+    trim: bool = True
+    pad: bool = True
+
+    @classmethod
+    def from_dict(cls, values):
+        known = {f.name for f in fields(cls)}
+        unknown = set(values) - known
+        if unknown:
+            raise ValueError(f"Unknown channel setting(s): {', '.join(sorted(unknown))}")
+        config = cls(**values)
+        if not isinstance(config.input_channel, int) or config.input_channel < 0:
+            raise ValueError(f"input_channel must be 0 or more, not {config.input_channel!r}")
+        if config.ctcss and not all(isinstance(t, (int, float)) and 0 < t < 300 for t in config.ctcss):
+            raise ValueError(f"ctcss must be a list of tones in Hz, not {config.ctcss!r}")
+        if config.format not in FORMATS:
+            raise ValueError(f"Unknown format '{config.format}' (choose from {', '.join(FORMATS)})")
+        if config.detector not in DETECTORS:
+            raise ValueError(f"Unknown detector '{config.detector}' "
+                             f"(choose from {', '.join(DETECTORS)})")
+        return config
+
+
+def load_channel_config(path):
+    """Read channel settings from a JSON file.
+
+    The file holds either a list of channel objects, or an object with a
+    "channels" list and optional "defaults" applied to every channel.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"channels": data}
+    defaults = data.get("defaults", {})
+    channels = [ChannelConfig.from_dict({**defaults, **ch}) for ch in data.get("channels", [])]
+    if not channels:
+        raise ValueError(f"{path}: no channels defined")
+    return channels
+
+
+class VoxChannel(object):
+    """VOX state machine of one channel, fed chunk by chunk by a VoxEngine.
+
+    While idle, chunks go to the pre-roll ring. A chunk above the threshold
+    starts a recording that streams to disk until the tail silence has passed;
+    the finished file is handed to the finaliser. With vox=False the channel
+    only records while 'force' is set (manual recording).
+    """
+
+    def __init__(self, config, finaliser, rate=RATE, index=0, log=print,
+                 on_state=None, on_saved=None, metadata=None, clock=None):
+        self.config = config
+        self.finaliser = finaliser
+        self.rate = config.sample_rate or rate   # 'rate' is the capture rate
+        self.index = index
+        self.vox = True
+        self.force = False
+        self.recording = False
+        self.level = 0.0
+        self.peak = 0.0   # level held for PEAK_HOLD_SECS, then decaying
+        self._peak_hold = 0.0
+        self.filename = ""
+        self.rec_start = 0.0
+        self.sessions = 0
+        self.dropped_samples = 0   # running totals, at this channel's rate
+        self.overflow_events = 0
+        self.triggers = 0
+        self.bytes_written = 0
+        self.durations = Histogram(DURATION_BUCKETS)
+        self.preroll = PreRoll(config.preroll, self.rate)
+        self.detector = make_detector(config, self.rate)
+        # All timing counts samples; the engine re-anchors the clock to the wall
+        # clock each time it opens the stream
+        self.clock = clock or SampleClock(time.time(), self.rate)
+        self.squelch = make_squelch(config, self.rate)
+        self.metadata = metadata or MetadataSource(config.meta_script, config.meta_server, log=log)
+        self._log = log
+        self._on_state = on_state
+        self._on_saved = on_saved
+        self._writer = None
+        self._last_voice = 0.0
+        self._lead = 0
+        self._meta = None
+        self._tone = None
+        self._lost_at_start = (0, 0)
+
+    @property
+    def label(self):
+        return self.config.name or f"ch{self.index}"
+
+    @property
+    def threshold(self):
+        """Trigger level in use; follows the noise floor in auto mode"""
+        return self.detector.threshold
+
+    def _say(self, msg):
+        self._log(f"[{self.config.name}] {msg}" if self.config.name else msg)
+
+    def _now(self):
+        return self.clock.now()
+
+    def anchor(self, when):
+        """Restart the sample clock at wall clock time 'when' (a new stream)"""
+        self.clock = SampleClock(when, self.rate)
+
+    def lost(self, samples, events, skipped=0):
+        """Account for audio the source lost before this channel saw it.
+
+        The 'skipped' part of it is known to have taken its time in the
+        stream, so the clock moves past it; the rest is only guessed from
+        the wall clock and leaves the clock alone.
+        """
+        self.clock.advance(skipped)
+        self.dropped_samples += samples
+        self.overflow_events += events
+
+    def feed(self, chunk):
+        self.clock.advance(len(chunk))
+        loud = self.detector.level(chunk)
+        self.level = level = min(max(loud, 0) / MAXIMUMVOL, 1.0)
+        if level >= self.peak:
+            self.peak = level
+            self._peak_hold = PEAK_HOLD_SECS
+        elif self._peak_hold > 0:
+            self._peak_hold -= len(chunk) / self.rate
+        else:
+            self.peak = max(level, self.peak - PEAK_DECAY * len(chunk) / self.rate)
+        voice = self.detector(chunk, loud) and self.vox
+        if self.squelch is not None:
+            voice = self.squelch(chunk) is not None and voice
+        if not self.recording:
+            if voice or self.force:
+                self._start(chunk, voice)
+            else:
+                self.preroll.push(chunk)
+            return
+        self._writer.write(chunk)
+        now = self._now()
+        if voice:
+            self._last_voice = now
+        if self.force:
+            return
+        if not self.vox or now > self._last_voice + self.config.tail_silence:
+            self._stop()
+
+    def update(self, **values):
+        """Change settings while running: 'vox', 'force' or any ChannelConfig field"""
+        for key, value in values.items():
+            if key in ("vox", "force"):
+                setattr(self, key, value)
+            elif hasattr(self.config, key):
+                setattr(self.config, key, value)
+            else:
+                raise ValueError(f"Unknown channel setting: {key}")
+        if "detector" in values:
+            self.detector = make_detector(self.config, self.rate)
+        if values.keys() & {"ctcss", "ctcss_window", "ctcss_ratio"}:
+            self.squelch = make_squelch(self.config, self.rate)
+
+    def metrics(self):
+        labels = (("channel", self.label),)
+        return [("vox_triggers_total", labels, self.triggers),
+                ("vox_recording", labels, int(self.recording)),
+                ("vox_written_bytes_total", labels, self.bytes_written),
+                ("vox_dropped_samples_total", labels, self.dropped_samples),
+                ("vox_overflow_events_total", labels, self.overflow_events),
+                ] + self.durations.rows("vox_recording_seconds", labels)
+
+    def status(self):
+        """Snapshot sent by a capture worker to its supervisor"""
+        return (self.index, self.level, self.recording, self.filename, self.rec_start, self.sessions,
+                self.threshold, self.dropped_samples, self.overflow_events, self.peak)
+
+    def close(self):
+        """Finish a recording in progress"""
+        if self.recording:
+            self._stop()
+        self.preroll.clear()
+        self.detector.reset()
+        if self.squelch is not None:
+            self.squelch.reset()
+
+    def _start(self, chunk, triggered):
+        pre = self.preroll.drain()
+        if not triggered:
+            pre = array('h')   # manual recordings start at the button press
+        self._lead = len(pre)
+        self._tone = self.squelch.tone if self.squelch is not None and triggered else None
+        self._lost_at_start = (self.dropped_samples, self.overflow_events)
+        if triggered:
+            self.triggers += 1
+        self._last_voice = self._now()   # end of 'chunk'
+        self.rec_start = self._last_voice - (self._lead + len(chunk)) / self.rate
+        self.filename = make_filename(self.config.outdir, self.config.prefix, self._last_voice)
+        self._meta = self.metadata.fetch()
+        self._writer = WavStreamWriter(f"{self.filename}.wav", self.rate)
+        self._writer.write(pre)
+        self._writer.write(chunk)
+        self.recording = True
+        self._say(f"Recording: {os.path.basename(self.filename)}.wav")
+        if self._on_state:
+            self._on_state(self, True)
+
+    def _stop(self):
+        self._writer.close()
+        self._writer = None
+        self.recording = False
+        rec_end = self._now()
+        self.durations.observe(rec_end - self.rec_start)
+        lost = (self.dropped_samples - self._lost_at_start[0],
+                self.overflow_events - self._lost_at_start[1])
+        self.finaliser.submit(os.path.basename(self.filename), self._finalise,
+                              self.filename, self.rec_start, rec_end, self._meta, self._lead,
+                              self.threshold, self._tone, lost)
+        if self._on_state:
+            self._on_state(self, False)
+
+    def _finalise(self, wav_filename, rec_start, rec_end, meta, lead, threshold, tone, lost=(0, 0)):
+        """Post-process a finished recording and write its JSON. Runs on the finaliser thread.
+
+        If encoding fails the WAV is kept and saved as usual, and the error is
+        raised at the end so the finaliser reports the job as failed."""
+        cfg = self.config
+        wav_path = f"{wav_filename}.wav"
+        postprocess_wav(wav_path, normalize=cfg.normalize,
+                        trim_threshold=threshold if cfg.trim else None,
+                        lead=lead, pad_secs=0.5 if cfg.pad else 0.0)
+        codec, ratio = "wav", 1.0
+        encode_error = None
+        if cfg.format != "wav":
+            try:
+                wav_path, ratio = encode_wav(wav_path, cfg.format, cfg.opus_bitrate)
+                codec = cfg.format
+            except (OSError, RuntimeError) as e:
+                encode_error = e
+        self.bytes_written += os.path.getsize(wav_path)
+
+        duration = rec_end - rec_start
+        meta = meta.result() if meta is not None else {}
+        if cfg.name:
+            meta["channel_name"] = cfg.name
+        if cfg.auto_threshold:
+            meta["threshold"] = round(threshold)
+        if tone is not None:
+            meta["ctcss_hz"] = tone
+        meta.update({
+            "start_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec_start)),
+            "end_time":   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec_end)),
+            "duration_s": round(duration, 1),
+            "dropped_samples": lost[0],
+            "overflow_events": lost[1],
+        })
+        if cfg.format != "wav":
+            meta["codec"] = codec
+            meta["compression_ratio"] = round(ratio, 2)
+        json_path = f"{wav_filename}.json"
+        with open(json_path, 'w') as jf:
+            json.dump(meta, jf, indent=4)
+
+        self.sessions += 1
+        self._say(f"Saved: {os.path.basename(wav_path)} ({duration:.1f}s)")
+        if self._on_saved:
+            self._on_saved(self, wav_path, duration)
+        if encode_error is not None:
+            raise RuntimeError(f"encoding to {cfg.format} failed, kept the WAV: {encode_error}")
+
+
+def total_losses(channels):
+    """(dropped samples, overflow events) over all devices of 'channels'.
+
+    Channels sharing a device see the same losses, so each device is
+    counted once, through its first channel.
+    """
+    first = {}
+    for ch in channels:
+        first.setdefault(ch.config.device, ch)
+    return (sum(ch.dropped_samples for ch in first.values()),
+            sum(ch.overflow_events for ch in first.values()))
+
+
+class VoxEngine(object):
+    """Serves any number of VoxChannels from one process.
+
+    Channels on the same input device share one AudioSource, made by
+    'source_factory' (make_source by default), and every device is read by
+    its own thread. A device is opened with as many input channels as its
+    highest 'input_channel' needs, and each chunk is split so every
+    VoxChannel sees only its own input. 'rate' is the capture rate;
+    a channel stored at a lower rate gets its input through a Decimator.
+    Blocking reads release the GIL, so devices are captured in parallel,
+    while post-processing stays on the shared finaliser. A stuck device is
+    reopened without disturbing the others.
+    """
+
+    def __init__(self, channels, rate=RATE, chunk_size=CHUNK_SIZE, callback=True, log=print,
+                 on_chunk=None, on_stuck=None, open_context=None, stuck_timeout=STUCK_TIMEOUT,
+                 source_factory=None):
+        self.channels = channels
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.stuck_timeout = stuck_timeout
+        self._log = log
+        self._on_chunk = on_chunk
+        self._on_stuck = on_stuck
+        self._open_context = open_context
+        self._make_source = source_factory or make_source
+        self.devices = {}
+        for ch in channels:
+            self.devices.setdefault(ch.config.device, []).append(ch)
+            decimation_factor(rate, ch.rate)   # fail early on a rate that cannot be reached
+            check_encoder(ch.config.format)
+        self.read_times = {device: Histogram(LATENCY_BUCKETS) for device in self.devices}
+        self.restarts = dict.fromkeys(self.devices, 0)
+
+    def run(self, stop_event):
+        """Capture until 'stop_event' is set. Blocks; channels are closed on return."""
+        threads = []
+        for device, channels in self.devices.items():
+            t = threading.Thread(target=self._device_loop, args=(device, channels, stop_event),
+                                 name=f"capture-{device}", daemon=True)
+            t.start()
+            threads.append(t)
+        try:
+            # Sleep rather than join here: a signal handler raising inside
+            # Thread.join() can leave the thread marked as finished
+            while any(t.is_alive() for t in threads):
+                time.sleep(0.2)
+        finally:
+            stop_event.set()
+            for t in threads:
+                t.join()
+            for ch in self.channels:
+                ch.metadata.close()
+
+    def update(self, index, **values):
+        """Change the settings of channel 'index' while running"""
+        self.channels[index].update(**values)
+
+    def metrics(self):
+        """Metric rows of the devices and channels, for render_metrics()"""
+        rows = []
+        for device in self.devices:
+            labels = (("device", device_label(device)),)
+            rows += self.read_times[device].rows("vox_chunk_read_seconds", labels)
+            rows.append(("vox_stream_restarts_total", labels, self.restarts[device]))
+        for ch in self.channels:
+            rows += ch.metrics()
+        return rows
+
+    def _open(self, device, width=1):
+        source = self._make_source(device, self.rate, self.chunk_size, width, self.callback)
+        if self._open_context is None:
+            source.open()
+        else:
+            with self._open_context():
+                source.open()
+        if source.channels < width:
+            source.close()
+            raise ValueError(f"has {source.channels} channel(s), input_channel {width - 1} requested")
+        return source
+
+    def _device_loop(self, device, channels, stop_event):
+        name = "default device" if device is None else f"device {device}"
+        width = max(ch.config.input_channel for ch in channels) + 1
+        read_times = self.read_times[device]
+        while not stop_event.is_set():
+            try:
+                engine = self._open(device, width)
+            except Exception as e:
+                self._log(f"Audio open failed on {name}: {e}")
+                return
+            factors = [decimation_factor(self.rate, ch.rate) for ch in channels]
+            decimators = [Decimator(f) if f > 1 else None for f in factors]
+            opened = time.time()
+            for ch in channels:
+                ch.anchor(opened)
+            dropped, skipped, overflows = 0, 0, 0
+            try:
+                while not stop_event.is_set():
+                    t0 = time.perf_counter()
+                    chunk = read_chunk_with_stuck_detect(engine, stop_event, self.stuck_timeout)
+                    if chunk is None:
+                        break
+                    read_times.observe(time.perf_counter() - t0)
+                    if engine.dropped_samples != dropped or engine.overflow_events != overflows:
+                        lost = engine.dropped_samples - dropped
+                        skip = engine.skipped_samples - skipped
+                        events = engine.overflow_events - overflows
+                        dropped, overflows = engine.dropped_samples, engine.overflow_events
+                        skipped = engine.skipped_samples
+                        for ch, f in zip(channels, factors):
+                            ch.lost(lost // f, events, skip // f)
+                    inputs = deinterleave(chunk, engine.channels)
+                    for ch, decimate in zip(channels, decimators):
+                        samples = inputs[ch.config.input_channel]
+                        if decimate is not None:
+                            samples = decimate(samples)
+                        ch.feed(samples)
+                        if self._on_chunk:
+                            self._on_chunk(ch, samples)
+                break   # clean exit
+            except RuntimeError as e:
+                self.restarts[device] += 1
+                self._log(f"⚠  {name}: {e} — restarting…")
+                if self._on_stuck:
+                    self._on_stuck(device, e)
+                time.sleep(1.0)
+            finally:
+                for ch in channels:
+                    ch.close()
+                try:
+                    engine.close()
+                except Exception:
+                    pass
+
+
+# ── Process per device ────────────────────────────────────────────────────────
+
+class ChannelStatus(object):
+    """Supervisor-side view of a channel that lives in a capture worker.
+
+    Has the attributes the status displays read from a VoxChannel, refreshed
+    from the worker's status reports.
+    """
+
+    def __init__(self, config, index):
+        self.config = config
+        self.index = index
+        self.level = 0.0
+        self.peak = 0.0
+        self.recording = False
+        self.filename = ""
+        self.rec_start = 0.0
+        self.sessions = 0
+        self.threshold = config.threshold
+        self.dropped_samples = 0
+        self.overflow_events = 0
+        self.lost_before = (0, 0)   # by workers that have since been restarted
+
+    @property
+    def label(self):
+        return self.config.name or f"ch{self.index}"
+
+    def apply(self, level, recording, filename, rec_start, sessions, threshold,
+              dropped_samples=0, overflow_events=0, peak=0.0):
+        self.level = level
+        self.peak = peak
+        self.recording = recording
+        self.filename = filename
+        self.rec_start = rec_start
+        self.sessions = sessions
+        self.threshold = threshold
+        self.dropped_samples = self.lost_before[0] + dropped_samples
+        self.overflow_events = self.lost_before[1] + overflow_events
+
+
+def _capture_worker(device, indexed_configs, settings, options, conn):
+    """Body of a capture worker process: one VoxEngine on one device.
+
+    Everything goes to the supervisor over 'conn': ("log", msg), ("status", [...]),
+    ("state", index, active, filename, rec_start), ("saved", index, wav_path,
+    duration), ("stuck", error) and, when options["metrics"] is set,
+    ("metrics", rows). The worker stops when the supervisor sends ("stop",) or
+    goes away, and exits after a stuck stream so that it is restarted in a
+    fresh process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the supervisor decides when to stop
+    stop_event = threading.Event()
+    send_lock = threading.Lock()
+    stuck = []
+
+    def send(*msg):
+        with send_lock:
+            try:
+                conn.send(msg)
+            except (OSError, ValueError):
+                stop_event.set()
+
+    def log(msg):
+        send("log", msg)
+
+    finaliser = Finaliser(workers=options["finalise_workers"], log=log)
+    channels = []
+    for index, cfg in indexed_configs:
+        ch = VoxChannel(cfg, finaliser, options["rate"], index=index, log=log,
+                        on_state=lambda c, active: send("state", c.index, active, c.filename, c.rec_start),
+                        on_saved=lambda c, path, duration: send("saved", c.index, path, duration),
+                        metadata=MetadataSource(cfg.meta_script, cfg.meta_server, log=log,
+                                                default=options["meta_default"]))
+        ch.update(**settings.get(index, {}))
+        channels.append(ch)
+    by_index = {ch.index: ch for ch in channels}
+
+    def read_commands():
+        while not stop_event.is_set():
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == "stop":
+                break
+            if msg[0] == "update":
+                by_index[msg[1]].update(**msg[2])
+        stop_event.set()
+
+    threading.Thread(target=read_commands, name="commands", daemon=True).start()
+
+    last_status = [0.0, 0.0]   # status, metrics
+
+    def on_chunk(channel, chunk):
+        now = time.time()
+        if now - last_status[0] >= options["status_interval"]:
+            last_status[0] = now
+            send("status", [ch.status() for ch in channels])
+        if options["metrics"] and now - last_status[1] >= METRICS_INTERVAL:
+            last_status[1] = now
+            send("metrics", engine.metrics() + finaliser.metrics())
+
+    def on_stuck(dev, error):
+        stuck.append(error)
+        send("stuck", str(error))
+        stop_event.set()
+
+    engine = VoxEngine(channels, rate=options["rate"], chunk_size=options["chunk_size"],
+                       callback=options["callback"], log=log, on_chunk=on_chunk,
+                       on_stuck=on_stuck, stuck_timeout=options["stuck_timeout"])
+    try:
+        engine.run(stop_event)
+    finally:
+        finaliser.close()
+        send("status", [ch.status() for ch in channels])
+        conn.close()
+    if stuck:
+        os._exit(3)
+
+
+class Supervisor(object):
+    """Runs one capture worker process per input device.
+
+    Detection and post-processing of each device then run on their own core
+    instead of sharing one interpreter's GIL. A worker that dies, or exits
+    after reporting a stuck stream, is started again after a delay that
+    doubles on every quick failure. 'channels' holds a ChannelStatus per
+    config, in config order, kept current from the workers' reports; the
+    callbacks get those objects, like VoxEngine's get VoxChannels.
+    """
+
+    def __init__(self, configs, rate=RATE, chunk_size=CHUNK_SIZE, callback=True, log=print,
+                 on_status=None, on_state=None, on_saved=None, on_stuck=None,
+                 finalise_workers=1, meta_default=None, stuck_timeout=STUCK_TIMEOUT, metrics=False):
+        self.channels = [ChannelStatus(cfg, i) for i, cfg in enumerate(configs)]
+        self._log = log
+        self._on_status = on_status
+        self._on_state = on_state
+        self._on_saved = on_saved
+        self._on_stuck = on_stuck
+        self._options = dict(rate=rate, chunk_size=chunk_size, callback=callback,
+                             finalise_workers=finalise_workers, meta_default=meta_default,
+                             stuck_timeout=stuck_timeout, status_interval=STATUS_INTERVAL,
+                             metrics=metrics)
+        self._settings = {}   # index -> settings changed with update(), reapplied on restart
+        self.devices = {}
+        for ch in self.channels:
+            self.devices.setdefault(ch.config.device, []).append(ch)
+            decimation_factor(rate, ch.config.sample_rate or rate)
+            check_encoder(ch.config.format)
+        self._workers = {}   # device -> [process, conn, started_at, restart_at, delay]
+        self._metrics = {}   # device -> latest metric rows of its worker
+        self._stuck = dict.fromkeys(self.devices, 0)
+        self._restarts = dict.fromkeys(self.devices, 0)
+        self._lock = threading.Lock()
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def update(self, index, **values):
+        """Change the settings of channel 'index'; also applied after restarts"""
+        with self._lock:
+            self._settings.setdefault(index, {}).update(values)
+            w = self._workers.get(self.channels[index].config.device)
+            if w is not None and w[0] is not None:
+                try:
+                    w[1].send(("update", index, values))
+                except OSError:
+                    pass
+
+    def run(self, stop_event):
+        """Supervise the workers until 'stop_event' is set. Blocks."""
+        for device in self.devices:
+            self._workers[device] = [None, None, 0.0, 0.0, RESTART_DELAY]
+        try:
+            while not stop_event.is_set():
+                now = time.time()
+                for device, w in self._workers.items():
+                    if w[0] is None and now >= w[3]:
+                        self._start_worker(device, w)
+                self._pump(0.2)
+        finally:
+            self._shutdown()
+
+    def _name(self, device):
+        return "default device" if device is None else f"device {device}"
+
+    def metrics(self):
+        """Metric rows of every worker as last reported, plus the restarts
+        seen here. Workers only report with metrics=True."""
+        rows = []
+        for device in self.devices:
+            labels = (("device", device_label(device)),)
+            rows.append(("vox_stream_restarts_total", labels, self._stuck[device]))
+            rows.append(("vox_worker_restarts_total", labels, self._restarts[device]))
+        for device, worker_rows in list(self._metrics.items()):
+            for name, labels, value in worker_rows:
+                if name == "vox_stream_restarts_total":
+                    continue   # a worker only lives through one
+                if not any(k in ("device", "channel") for k, _ in labels):
+                    labels += (("device", device_label(device)),)   # one finaliser per worker
+                rows.append((name, labels, value))
+        return rows
+
+    def _start_worker(self, device, w):
+        parent, child = self._ctx.Pipe()
+        indexed = [(ch.index, ch.config) for ch in self.devices[device]]
+        with self._lock:
+            settings = {i: dict(v) for i, v in self._settings.items()}
+            proc = self._ctx.Process(target=_capture_worker, name=f"capture-{device}",
+                                     args=(device, indexed, settings, self._options, child))
+            proc.start()
+            w[0], w[1], w[2] = proc, parent, time.time()
+        child.close()
+
+    def _pump(self, timeout):
+        """Handle worker messages and exits for up to 'timeout' seconds"""
+        live = {w[1]: (d, w) for d, w in self._workers.items() if w[0] is not None}
+        if not live:
+            time.sleep(timeout)
+            return
+        for conn in wait_connections(list(live), timeout):
+            device, w = live[conn]
+            try:
+                while conn.poll():
+                    self._handle(device, conn.recv())
+            except (EOFError, OSError):
+                self._reap(device, w)
+
+    def _handle(self, device, msg):
+        kind = msg[0]
+        if kind == "log":
+            self._log(msg[1])
+        elif kind == "status":
+            for index, *values in msg[1]:
+                self.channels[index].apply(*values)
+            if self._on_status:
+                self._on_status(self.devices[device][0])
+        elif kind == "state":
+            ch = self.channels[msg[1]]
+            ch.recording, ch.filename, ch.rec_start = msg[2], msg[3], msg[4]
+            if self._on_state:
+                self._on_state(ch, msg[2])
+        elif kind == "saved":
+            ch = self.channels[msg[1]]
+            ch.sessions += 1
+            if self._on_saved:
+                self._on_saved(ch, msg[2], msg[3])
+        elif kind == "metrics":
+            self._metrics[device] = msg[1]
+        elif kind == "stuck":
+            self._stuck[device] += 1
+            if self._on_stuck:
+                self._on_stuck(device, RuntimeError(msg[1]))
+
+    def _reap(self, device, w):
+        """A worker closed its pipe: collect it and schedule its restart"""
+        proc, conn = w[0], w[1]
+        proc.join(timeout=5.0)
+        conn.close()
+        for ch in self.devices[device]:
+            ch.level, ch.peak, ch.recording = 0.0, 0.0, False
+            ch.lost_before = (ch.dropped_samples, ch.overflow_events)
+        w[0] = w[1] = None
+        if time.time() - w[2] > 60.0:
+            w[4] = RESTART_DELAY   # ran long enough; start over with a short delay
+        if proc.exitcode != 0:
+            self._restarts[device] += 1
+        if proc.exitcode not in (0, 3):
+            self._log(f"⚠  Worker for {self._name(device)} died (exit code {proc.exitcode})"
+                      f" — restarting in {w[4]:.0f}s")
+        w[3] = time.time() + w[4]
+        w[4] = min(w[4] * 2, RESTART_DELAY_MAX)
+
+    def _shutdown(self):
+        """Ask every worker to stop and wait while they finish their recordings"""
+        for w in self._workers.values():
+            if w[0] is not None:
+                try:
+                    w[1].send(("stop",))
+                except OSError:
+                    pass
+        deadline = time.time() + 30.0
+        while any(w[0] is not None for w in self._workers.values()) and time.time() < deadline:
+            self._pump(0.2)
+        for w in self._workers.values():
+            if w[0] is not None:
+                w[0].terminate()
+                w[0].join()
+                w[1].close()
+                w[0] = None
+
+
+# ── Offline files ─────────────────────────────────────────────────────────────
+
+def _wav_layout(mm):
+    """(channels, rate, sample width, data offset, data length) of a RIFF/WAVE file"""
+    if mm[:4] != b"RIFF" or mm[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(mm):
+        cid = mm[pos:pos + 4]
+        size = int.from_bytes(mm[pos + 4:pos + 8], "little")
+        body = pos + 8
+        if cid == b"fmt ":
+            tag = int.from_bytes(mm[body:body + 2], "little")
+            channels = int.from_bytes(mm[body + 2:body + 4], "little")
+            rate = int.from_bytes(mm[body + 4:body + 8], "little")
+            width = int.from_bytes(mm[body + 14:body + 16], "little") // 8
+            fmt = (tag, channels, rate, width)
+        elif cid == b"data":
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            tag, channels, rate, width = fmt
+            if tag not in (1, 0xFFFE) or width != SAMPLE_WIDTH:
+                raise ValueError("only 16-bit PCM files are supported")
+            # A recorder killed mid-file leaves the size unpatched; take what is there
+            size = min(size, len(mm) - body)
+            return channels, rate, width, body, size - size % (channels * width)
+        pos = body + size + (size & 1)
+    raise ValueError("no data chunk")
+
+
+class WavFileReader(object):
+    """Reads a 16-bit PCM WAV file chunk by chunk.
+
+    The header is parsed through a memory map, which is closed again; the
+    samples are read with plain file reads, so only one chunk is held at a
+    time and hours-long captures are not kept in memory. (Pages of a map
+    stay resident once touched.) read() returns interleaved native-order
+    samples like CaptureEngine.read(), and None at the end of the file.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._file = open(path, "rb")
+        try:
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.channels, self.rate, _, offset, size = _wav_layout(mm)
+            self._file.seek(offset)
+        except Exception:
+            self._file.close()
+            raise
+        self.frames = size // (self.channels * SAMPLE_WIDTH)
+        self._pos = 0   # frames read
+
+    @property
+    def duration(self):
+        return self.frames / self.rate
+
+    def read(self):
+        if self._pos >= self.frames:
+            return None
+        n = min(self.chunk_size, self.frames - self._pos)
+        chunk = array('h')
+        chunk.frombytes(self._file.read(n * self.channels * SAMPLE_WIDTH))
+        if byteorder == 'big':
+            chunk.byteswap()
+        self._pos += n
+        return chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def segment_file(path, configs, finaliser, log=print, start=None, chunk_size=CHUNK_SIZE):
+    """Cut a recorded WAV file into VOX clips with the channels' live rules.
+
+    The file is read as fast as the CPU allows. Each channel keeps a
+    SampleClock starting at 'start' (default: the file's modification time
+    minus its length, when a recorder would have begun writing it), so clip
+    names and JSON times are those of the original transmissions. Returns
+    (seconds of audio, clips started).
+    """
+    with WavFileReader(path, chunk_size) as reader:
+        if start is None:
+            start = os.path.getmtime(path) - reader.duration
+        width = reader.channels
+        channels = []
+        for i, cfg in enumerate(configs):
+            if cfg.input_channel >= width:
+                raise ValueError(f"{path}: has {width} channel(s), no input_channel {cfg.input_channel}")
+            rate = cfg.sample_rate or reader.rate
+            factor = decimation_factor(reader.rate, rate)
+            check_encoder(cfg.format)
+            ch = VoxChannel(cfg, finaliser, reader.rate, index=i, log=log,
+                            metadata=MetadataSource("", default={"source_file": os.path.basename(path)}),
+                            clock=SampleClock(start, rate))
+            channels.append((ch, Decimator(factor) if factor > 1 else None))
+        starts = 0
+        try:
+            while True:
+                chunk = reader.read()
+                if chunk is None:
+                    break
+                inputs = deinterleave(chunk, width)
+                for ch, decimate in channels:
+                    samples = inputs[ch.config.input_channel]
+                    if decimate is not None:
+                        samples = decimate(samples)
+                    was_recording = ch.recording
+                    ch.feed(samples)
+                    starts += ch.recording and not was_recording
+        finally:
+            for ch, _ in channels:
+                ch.close()
+        return reader.duration, starts
+
+
+def find_wav_files(target):
+    """WAV files under a directory (recursively), or matching a glob pattern"""
+    if os.path.isdir(target):
+        target = os.path.join(target, "**", "*.wav")
+    return sorted(os.path.abspath(p) for p in glob.glob(os.path.expanduser(target), recursive=True)
+                  if os.path.isfile(p))
+
+
+def config_digest(configs):
+    """Short hash of channel settings; manifest entries made with others do not count"""
+    text = json.dumps([asdict(c) for c in configs], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def read_manifest(path, digest=None):
+    """Files already done according to a batch manifest: {path: entry}
+
+    With a 'digest' from config_digest(), only files done with those
+    settings count.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue   # a line cut short by an interrupted run
+            if entry.get("status") == "ok" and digest in (None, entry.get("config")):
+                done[entry["file"]] = entry
+    return done
+
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _stage(configs):
+    """Configs writing into a fresh staging directory inside each output directory.
+
+    Returns (configs, {output directory: staging directory}).
+    """
+    staging = {}
+    staged = []
+    for cfg in configs:
+        outdir = os.path.expanduser(cfg.outdir)
+        if outdir not in staging:
+            staging[outdir] = os.path.join(outdir, BATCH_STAGING + uuid.uuid4().hex[:8])
+            os.makedirs(staging[outdir])
+        staged.append(replace(cfg, outdir=staging[outdir]))
+    return staged, staging
+
+
+def _unstage(staging, keep):
+    """Move the staged clips into their output directories if 'keep', then drop the staging"""
+    for outdir, tmp in staging.items():
+        if keep:
+            for name in os.listdir(tmp):
+                os.replace(os.path.join(tmp, name), os.path.join(outdir, name))
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _segment_one(job):
+    """Batch pool worker: segment one file with a finaliser of its own.
+
+    Clips are written to staging directories and only moved to the output
+    directories once the whole file has succeeded, so a file that fails or
+    is cut short leaves no clips behind to be written again by a rerun.
+    """
+    path, configs, digest = job
+    problems = []
+    staging = {}
+    t0 = time.time()
+    finaliser = Finaliser(workers=1, log=lambda msg: None,
+                          on_error=lambda name, e: problems.append(f"{name}: {e}"))
+    try:
+        staged, staging = _stage(configs)
+        seconds, clips = segment_file(path, staged, finaliser, log=lambda msg: None)
+        error = None
+    except Exception as e:
+        seconds, clips, error = 0.0, 0, str(e)
+    finally:
+        finaliser.close()
+    _unstage(staging, keep=not (error or problems))
+    # A file with failed clips is not done, so a rerun does it again
+    entry = {"file": path, "config": digest, "status": "error" if error or problems else "ok",
+             "audio_s": round(seconds, 1), "clips": clips, "elapsed_s": round(time.time() - t0, 2)}
+    if error:
+        entry["error"] = error
+    elif problems:
+        entry["error"] = f"{len(problems)} clip(s) failed, first {problems[0]}"
+    return entry
+
+
+def batch_segment(paths, configs, manifest, workers=None, log=print):
+    """Segment many files over a process pool, resumably.
+
+    Every finished file is appended to the 'manifest' (JSON lines) as its
+    result arrives, and files listed there as done with the same channel
+    settings are skipped, so an interrupted run continues where it stopped
+    and a run with new settings does every file again. Clips of files that
+    failed or were cut short never reach the output directories. Each worker reads one file
+    at a time through WavFileReader, which holds one chunk in memory at a
+    time however long the files are. Yields (entry, audio seconds per wall second so far).
+    """
+    for outdir in {os.path.expanduser(c.outdir) for c in configs}:
+        for tmp in glob.glob(os.path.join(glob.escape(outdir), BATCH_STAGING + "*")):
+            log(f"Removing {tmp}, left by an interrupted run")
+            shutil.rmtree(tmp, ignore_errors=True)
+    digest = config_digest(configs)
+    done = read_manifest(manifest, digest)
+    todo = [p for p in paths if p not in done]
+    if len(todo) < len(paths):
+        log(f"Skipping {len(paths) - len(todo)} file(s) already done with these settings in {manifest}")
+    if not todo:
+        return
+    t0 = time.time()
+    audio = 0.0
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_ignore_sigint) as pool, open(manifest, "a") as mf:
+        for entry in pool.imap_unordered(_segment_one, [(p, configs, digest) for p in todo]):
+            mf.write(json.dumps(entry) + "\n")
+            mf.flush()
+            audio += entry["audio_s"]
+            yield entry, audio / max(time.time() - t0, 1e-6)
+
+
+# ── Stand-in audio sources ────────────────────────────────────────────────────
+
+class SyntheticSource(AudioSource):
+    """Generated audio for running the recorder without a sound card.
+
+    Every channel carries a noise floor of peak 'noise' and, every 'every'
+    seconds, a 'length' second burst of a 1 kHz tone at peak 'level'. The
+    bursts of successive channels are spread evenly over the period, so a
+    16-channel source keeps a few channels recording at any time. Chunks
+    are sliced from precomputed one-second tables, so generating them
+    costs next to nothing next to the detection being measured.
+
+    With 'realtime' the source delivers audio at 'rate' like a sound card;
+    otherwise as fast as it is read. After 'stuck_after' seconds it stops
+    delivering, which exercises stuck stream detection and restart.
+    """
+
+    def __init__(self, rate=RATE, chunk_size=CHUNK_SIZE, channels=1, noise=100, level=8000,
+                 every=10.0, length=2.0, stuck_after=None, realtime=True, seed=1):
+        AudioSource.__init__(self, rate, chunk_size, channels)
+        self.every = every
+        self.length = length
+        self.stuck_after = stuck_after
+        self.realtime = realtime
+        rnd = random.Random(seed)
+        # One second plus a chunk, so a chunk never wraps around the table end
+        n = rate + chunk_size
+        self._noise = array('h', (rnd.randint(-noise, noise) for _ in range(n)))
+        self._burst = array('h', (max(-32767, min(32767, int(level * math.sin(2 * math.pi * 1000 * i / rate))
+                                                 + self._noise[i])) for i in range(n)))
+        self._pos = 0      # frames delivered
+        self._opened = 0.0
+
+    def open(self):
+        AudioSource.open(self)
+        self._opened = self.last_delivery
+        return self
+
+    def _stuck(self):
+        return self.stuck_after is not None and time.time() - self._opened > self.stuck_after
+
+    def available(self):
+        if self._stuck():
+            return 0
+        if not self.realtime:
+            return self.chunk_size
+        return int((time.time() - self._opened) * self.rate) - self._pos
+
+    def read(self, timeout=None):
+        n = self.chunk_size
+        parts = []
+        for c in range(self.channels):
+            t = (self._pos / self.rate + c * self.every / self.channels) % self.every
+            table = self._burst if t < self.length else self._noise
+            start = (self._pos + 7919 * c) % self.rate
+            parts.append(table[start:start + n])
+        if self.channels == 1:
+            chunk = parts[0]
+        else:
+            chunk = array('h', bytes(SAMPLE_WIDTH * n * self.channels))
+            for c, part in enumerate(parts):
+                chunk[c::self.channels] = part
+        self._pos += n
+        self.last_delivery = time.time()
+        return chunk
+
+
+class WavFileSource(AudioSource):
+    """Plays a 16-bit WAV file into the recorder as if it were a sound card.
+
+    Delivers in real time unless 'realtime' is off, and starts over at the
+    end when 'loop' is set; otherwise read() returns None at the end of the
+    file, which ends that device's capture. The file must be at the capture
+    rate, 'rate', when one is given.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, rate=None, realtime=True, loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self._reader = None
+        self._pos = 0
+        self._opened = 0.0
+        with WavFileReader(path, chunk_size) as reader:
+            AudioSource.__init__(self, reader.rate, chunk_size, reader.channels)
+        if rate is not None and rate != self.rate:
+            raise ValueError(f"{path} is {self.rate} Hz, capture rate is {rate} Hz")
+
+    def open(self):
+        AudioSource.open(self)
+        self._reader = WavFileReader(self.path, self.chunk_size)
+        self._opened = self.last_delivery
+        self._pos = 0
+        return self
+
+    def available(self):
+        if not self.realtime:
+            return self.chunk_size
+        return int((time.time() - self._opened) * self.rate) - self._pos
+
+    def read(self, timeout=None):
+        chunk = self._reader.read()
+        if chunk is None and self.loop:
+            self._reader.close()
+            self._reader = WavFileReader(self.path, self.chunk_size)
+            chunk = self._reader.read()
+        if chunk is not None:
+            self._pos += len(chunk) // self.channels
+            self.last_delivery = time.time()
+        return chunk
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+def _source_options(spec):
+    """Parse "key=value,..." into keyword arguments of numbers and booleans"""
+    options = {}
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        value = value.strip()
+        if value.lower() in ("yes", "true", "on", "no", "false", "off"):
+            options[key] = value.lower() in ("yes", "true", "on")
+        else:
+            try:
+                options[key] = int(value)
+            except ValueError:
+                options[key] = float(value)
+    return options
+
+
+def make_source(device, rate=RATE, chunk_size=CHUNK_SIZE, channels=1, callback=False):
+    """The AudioSource for a channel 'device' setting.
+
+    "synth" or "synth:channels=16,every=5,stuck_after=30,..." gives a
+    SyntheticSource, "file:PATH" or "file:PATH,loop=yes,realtime=no" a
+    WavFileSource; anything else names a sound card for CaptureEngine.
+    """
+    if isinstance(device, str) and (device == "synth" or device.startswith("synth:")):
+        options = _source_options(device[len("synth:"):])
+        options["channels"] = max(channels, options.get("channels", 1))
+        return SyntheticSource(rate, chunk_size, **options)
+    if isinstance(device, str) and device.startswith("file:"):
+        path, _, spec = device[len("file:"):].partition(",")
+        return WavFileSource(os.path.expanduser(path), chunk_size, rate=rate, **_source_options(spec))
+    return CaptureEngine(rate=rate, chunk_size=chunk_size, device_index=device,
+                         callback=callback, channels=channels)
@@ -11,26 +11,24 @@ from tkinter import filedialog, messagebox, scrolledtext
 import threading
 import time
 import os
-import uuid
 import json
-import subprocess
 import queue
-from sys import byteorder
-from array import array
-from struct import pack
 
 try:
     import pyaudio
-    import wave
     PYAUDIO_OK = True
 except ImportError:
     PYAUDIO_OK = False
 
+from voxcore import (ChannelConfig, VoxChannel, VoxEngine, Finaliser, MetadataSource, Supervisor,
+                     DETECTORS, FORMATS, load_channel_config, total_losses)
+
 __version__ = "2026.06.18.01"
 
 RATE        = 44100
+CAPTURE_RATES = (44100, 48000, 96000)
+STORE_RATES   = ("same", "8000", "11025", "16000", "22050", "24000")
 CHUNK_SIZE  = 1024
-FORMAT_STR  = "paInt16"
 MAXIMUMVOL  = 32767
 NUM_VU_BARS = 40
 
@@ -56,6 +54,121 @@ SANS      = "Sans 9"
 PX = 16   # standard horizontal padding for settings page widgets
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+class VuMeter(object):
+    """Segmented level meter on a canvas, with a dashed threshold marker and
+    a peak-hold segment.
+
+    Each segment remembers its colour, so an update only touches the
+    segments that change, and an update that changes nothing in what is
+    shown costs no Tk calls at all. Resizing moves the existing items.
+    """
+
+    def __init__(self, parent, height=40, threshold=2000, show_label=True):
+        self.canvas     = tk.Canvas(parent, height=height, bg=BG3,
+                                    highlightthickness=0)
+        self.level      = 0
+        self.peak       = 0
+        self.threshold  = threshold
+        self.recording  = False
+        self.show_label = show_label
+        self._rects     = []
+        self._colors    = []   # fill of each rectangle as last set
+        self._shown     = None   # what apply_level() last painted
+        self._size      = (0, 0)
+        self._thr_items = []
+        self._thr_drawn = None   # (x, width, height) the marker was placed at
+        self.canvas.bind("<Configure>", self.redraw)
+
+    def redraw(self, event=None):
+        w = self.canvas.winfo_width()
+        h = self.canvas.winfo_height()
+        if w < 10 or (w, h) == self._size:
+            return
+        self._size = (w, h)
+        seg_w  = w / NUM_VU_BARS
+        gap    = max(1, int(seg_w * 0.18))
+        bar_h  = h - 10   # bottom 10 px reserved for triangle marker
+        for i in range(NUM_VU_BARS):
+            x0 = int(i * seg_w)
+            x1 = int((i + 1) * seg_w) - gap
+            if i < len(self._rects):
+                self.canvas.coords(self._rects[i], x0, 4, x1, bar_h - 2)
+            else:
+                self._rects.append(self.canvas.create_rectangle(x0, 4, x1, bar_h - 2,
+                                                                fill=BG2, outline=""))
+                self._colors.append(BG2)
+        self.draw_threshold_marker(w, bar_h, h)
+        self.apply_level(self.level, self.recording, self.peak)
+
+    def draw_threshold_marker(self, canvas_w=None, bar_h=None, canvas_h=None):
+        """Place the marker at the threshold. Existing items are moved, and
+        only when the marker lands on another pixel."""
+        if canvas_w is None:
+            canvas_w, canvas_h = self._size
+        if canvas_w < 10:
+            return
+        if canvas_h is None:
+            canvas_h = self.canvas.winfo_height()
+        if bar_h is None:
+            bar_h = canvas_h - 10
+        x = int(min(self.threshold / MAXIMUMVOL, 1.0) * canvas_w)
+        if (x, canvas_w, canvas_h) == self._thr_drawn:
+            return
+        self._thr_drawn = (x, canvas_w, canvas_h)
+        half   = 5
+        lbl_x  = x + 4 if x < canvas_w - 32 else x - 4
+        anchor = "nw"  if x < canvas_w - 32 else "ne"
+        if self._thr_items:
+            self.canvas.coords(self._thr_items[0], x, 2, x, bar_h)
+            self.canvas.coords(self._thr_items[1], x - half, bar_h + 1, x + half, bar_h + 1,
+                               x, canvas_h - 1)
+            if self.show_label:
+                self.canvas.coords(self._thr_items[2], lbl_x, 4)
+                self.canvas.itemconfig(self._thr_items[2], anchor=anchor)
+            return
+        self._thr_items = [
+            self.canvas.create_line(x, 2, x, bar_h, fill=AMBER, width=2, dash=(3, 2)),
+            self.canvas.create_polygon(x - half, bar_h + 1,
+                                       x + half, bar_h + 1,
+                                       x,        canvas_h - 1,
+                                       fill=AMBER, outline=""),
+        ]
+        if self.show_label:
+            self._thr_items.append(self.canvas.create_text(
+                lbl_x, 4, text="THR", font="Monospace 7",
+                fill=AMBER, anchor=anchor))
+
+    def set_threshold(self, threshold):
+        """Move the marker; costs no Tk calls unless its pixel or the lit
+        segments change, so it can follow an auto threshold every update."""
+        self.threshold = threshold
+        self.draw_threshold_marker()
+        self.apply_level(self.level, self.recording, self.peak)
+
+    def apply_level(self, level_0_to_1, recording=False, peak=None):
+        """Show 'level' and the held 'peak' (0..1; None = no peak segment)"""
+        self.level     = level_0_to_1
+        self.peak      = peak or 0
+        self.recording = recording
+        lit_count = int(level_0_to_1 * NUM_VU_BARS)
+        peak_bar  = min(int(self.peak * NUM_VU_BARS), NUM_VU_BARS - 1) if peak else -1
+        thr_bar   = int(self.threshold / MAXIMUMVOL * NUM_VU_BARS)
+        shown = (lit_count, peak_bar, thr_bar, recording, len(self._rects))
+        if shown == self._shown:
+            return
+        self._shown = shown
+        for i, r in enumerate(self._rects):
+            if i < lit_count or i == peak_bar:
+                col = (RED if recording else AMBER) if i >= thr_bar \
+                      else (GREEN if i >= max(0, thr_bar - 4) else GREEN_DIM)
+            else:
+                col = BG2
+            if col != self._colors[i]:
+                self._colors[i] = col
+                self.canvas.itemconfig(r, fill=col)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 class VoxRecorderApp(tk.Tk):
     def __init__(self):
@@ -71,28 +184,42 @@ class VoxRecorderApp(tk.Tk):
         self.manual_active  = False
         self.stop_event     = threading.Event()
         self.audio_thread   = None
-        self.vu_queue       = queue.Queue(maxsize=4)
         self.log_queue      = queue.Queue()
         self.rec_start_time = 0
         self.session_count  = 0
-        self._last_vu_level = 0
-        self._vu_rects      = []
-        self._thr_line      = None
-        self._thr_tri       = None
-        self._thr_lbl_id    = None
+        self._engine        = None   # VoxEngine or Supervisor while running
+        self._channels      = []   # its channels (or their status views); [0] is the main channel
+        self._meters        = []   # VuMeter per channel, same order
+        # Post-processing runs here so the audio thread never stops reading
+        self._finaliser     = Finaliser(workers=1, depth=8,
+                                        log=lambda m: self._log(m, color=TEXT_DIM))
 
         # ── Config vars ──
         self.vox_threshold   = tk.IntVar(value=2000)
         self.tail_silence    = tk.DoubleVar(value=5.0)
+        self.preroll_secs    = tk.DoubleVar(value=1.0)
+        self.detector_type   = tk.StringVar(value="peak")
+        self.close_threshold = tk.IntVar(value=0)       # 0 = same as threshold
+        self.min_open        = tk.DoubleVar(value=0.0)
+        self.auto_threshold  = tk.BooleanVar(value=False)
+        self.margin_db       = tk.DoubleVar(value=12.0)
+        self.ctcss_tones     = tk.StringVar(value="")      # "88.5, 100.0"; empty = no tone squelch
         self.filename_prefix = tk.StringVar(value="voxrecord")
         self.save_path       = tk.StringVar(value=os.path.expanduser("~/vox-records"))
         self.meta_script     = tk.StringVar(value="")
+        self.meta_server     = tk.BooleanVar(value=False)
+        self.channels_file   = tk.StringVar(value="")
         self.channel_name    = tk.StringVar(value="")
         self.normalize_audio = tk.BooleanVar(value=True)
         self.trim_audio      = tk.BooleanVar(value=True)
         self.add_silence_pad = tk.BooleanVar(value=True)
+        self.output_format   = tk.StringVar(value="wav")
         self.mode_var        = tk.StringVar(value="vox")
         self.audio_device_idx= tk.IntVar(value=-1)   # -1 = default
+        self.callback_capture= tk.BooleanVar(value=True)
+        self.capture_rate    = tk.IntVar(value=RATE)
+        self.store_rate      = tk.StringVar(value="same")
+        self.process_per_device = tk.BooleanVar(value=False)
 
         # Populated after pyaudio init
         self._device_names  = []   # list of (index, name) for input devices
@@ -159,6 +286,10 @@ class VoxRecorderApp(tk.Tk):
         self._session_label = tk.Label(sb, text="Sessions: 0", font=MONO_SM,
                                         bg=BG2, fg=TEXT_DIM)
         self._session_label.pack(side="right")
+        self._lost_label = tk.Label(sb, text="Lost: 0 smp / 0 ovf", font=MONO_SM,
+                                    bg=BG2, fg=TEXT_DIM, padx=12)
+        self._lost_label.pack(side="right")
+        self._lost = (0, 0)
 
     def _show_page(self, key):
         self._page_main.pack_forget()
@@ -190,10 +321,8 @@ class VoxRecorderApp(tk.Tk):
         vu_wrap = tk.Frame(parent, bg=BG3, pady=6, padx=8)
         vu_wrap.pack(fill="x", pady=(2, 2))
 
-        self._vu_canvas = tk.Canvas(vu_wrap, height=40, bg=BG3,
-                                     highlightthickness=0)
-        self._vu_canvas.pack(fill="x")
-        self._vu_canvas.bind("<Configure>", self._redraw_vu_bars)
+        self._vu = VuMeter(vu_wrap, height=40, threshold=self.vox_threshold.get())
+        self._vu.canvas.pack(fill="x")
 
         thr_row = tk.Frame(vu_wrap, bg=BG3)
         thr_row.pack(fill="x", pady=(4, 0))
@@ -208,73 +337,44 @@ class VoxRecorderApp(tk.Tk):
         tk.Label(thr_row, textvariable=self.vox_threshold, width=5,
                  font=MONO_SM, bg=BG3, fg=GREEN).pack(side="left")
         self.vox_threshold.trace_add("write", self._on_threshold_change)
+        self.tail_silence.trace_add("write", self._on_tail_change)
+
+        # One compact strip per extra channel from the channel config file
+        self._strips = tk.Frame(parent, bg=BG)
+        self._strips.pack(fill="x")
+
+    def _build_strips(self, channels):
+        for w in self._strips.winfo_children():
+            w.destroy()
+        meters = []
+        if channels:
+            self._section_hdr(self._strips, "CHANNELS")
+        for ch in channels:
+            r = tk.Frame(self._strips, bg=BG3, pady=2, padx=8)
+            r.pack(fill="x", pady=(0, 1))
+            tk.Label(r, text=ch.label[:14], width=14, anchor="w", font=MONO_SM,
+                     bg=BG3, fg=TEXT_DIM).pack(side="left")
+            m = VuMeter(r, height=24, threshold=ch.config.threshold, show_label=False)
+            m.canvas.pack(side="left", fill="x", expand=True)
+            meters.append(m)
+        return meters
 
-    def _redraw_vu_bars(self, event=None):
-        self._vu_canvas.delete("all")
-        self._vu_rects   = []
-        self._thr_line   = None
-        self._thr_tri    = None
-        self._thr_lbl_id = None
-        w = self._vu_canvas.winfo_width()
-        if w < 10:
+    def _on_threshold_change(self, *_):
+        try:
+            thr = self.vox_threshold.get()
+        except tk.TclError:
             return
-        seg_w  = w / NUM_VU_BARS
-        gap    = max(1, int(seg_w * 0.18))
-        h      = self._vu_canvas.winfo_height()
-        bar_h  = h - 10   # bottom 10 px reserved for triangle marker
-        for i in range(NUM_VU_BARS):
-            x0 = int(i * seg_w)
-            x1 = int((i + 1) * seg_w) - gap
-            r  = self._vu_canvas.create_rectangle(x0, 4, x1, bar_h - 2,
-                                                    fill=BG2, outline="")
-            self._vu_rects.append(r)
-        self._draw_threshold_marker(w, bar_h, h)
-        self._apply_vu_level(self._last_vu_level)
+        self._vu.set_threshold(thr)
+        if self._engine is not None:
+            self._engine.update(0, threshold=thr)
 
-    def _draw_threshold_marker(self, canvas_w=None, bar_h=None, canvas_h=None):
-        if canvas_w is None:
-            canvas_w = self._vu_canvas.winfo_width()
-        if canvas_w < 10:
+    def _on_tail_change(self, *_):
+        try:
+            tail = self.tail_silence.get()
+        except tk.TclError:
             return
-        if canvas_h is None:
-            canvas_h = self._vu_canvas.winfo_height()
-        if bar_h is None:
-            bar_h = canvas_h - 10
-        for item in [self._thr_line, self._thr_tri, self._thr_lbl_id]:
-            if item is not None:
-                self._vu_canvas.delete(item)
-        x = int(min(self.vox_threshold.get() / MAXIMUMVOL, 1.0) * canvas_w)
-        self._thr_line = self._vu_canvas.create_line(
-            x, 2, x, bar_h, fill=AMBER, width=2, dash=(3, 2))
-        half = 5
-        self._thr_tri = self._vu_canvas.create_polygon(
-            x - half, bar_h + 1,
-            x + half, bar_h + 1,
-            x,        canvas_h - 1,
-            fill=AMBER, outline="")
-        lbl_x  = x + 4 if x < canvas_w - 32 else x - 4
-        anchor = "nw"  if x < canvas_w - 32 else "ne"
-        self._thr_lbl_id = self._vu_canvas.create_text(
-            lbl_x, 4, text="THR", font="Monospace 7",
-            fill=AMBER, anchor=anchor)
-
-    def _on_threshold_change(self, *_):
-        if self._vu_canvas.winfo_width() > 10:
-            self._draw_threshold_marker()
-            self._apply_vu_level(self._last_vu_level)
-
-    def _apply_vu_level(self, level_0_to_1):
-        self._last_vu_level = level_0_to_1
-        thr_ratio = self.vox_threshold.get() / MAXIMUMVOL
-        lit_count = int(level_0_to_1 * NUM_VU_BARS)
-        thr_bar   = int(thr_ratio * NUM_VU_BARS)
-        for i, r in enumerate(self._vu_rects):
-            if i < lit_count:
-                col = (RED if self.recording else AMBER) if i >= thr_bar \
-                      else (GREEN if i >= max(0, thr_bar - 4) else GREEN_DIM)
-            else:
-                col = BG2
-            self._vu_canvas.itemconfig(r, fill=col)
+        if self._engine is not None:
+            self._engine.update(0, tail_silence=tail)
 
     # ── Controls ───────────────────────────────────────────────────────────────
 
@@ -401,6 +501,27 @@ class VoxRecorderApp(tk.Tk):
         tk.Button(dev_row, text="↺ Refresh", command=self._populate_devices,
                   font=MONO_SM, bg=BG2, fg=TEXT, relief="flat",
                   padx=6, pady=2, cursor="hand2", bd=0).pack(side="left", padx=(4, 0))
+        cb_row = tk.Frame(inner, bg=BG)
+        cb_row.pack(fill="x", padx=PX, pady=(0, 8))
+        tk.Checkbutton(cb_row, text="Callback capture", variable=self.callback_capture,
+                       font=MONO_SM, bg=BG, fg=TEXT, selectcolor=BG3,
+                       activebackground=BG, activeforeground=GREEN,
+                       highlightthickness=0).pack(side="left")
+        tk.Label(cb_row, text="— audio pushed by PortAudio, no polling (lower latency and CPU)",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
+
+        self._s_lbl(inner, "Capture rate / stored rate (Hz)")
+        rate_row = row(8)
+        for var, choices in ((self.capture_rate, CAPTURE_RATES), (self.store_rate, STORE_RATES)):
+            m = tk.OptionMenu(rate_row, var, *choices)
+            m.config(font=MONO_SM, bg=BG3, fg=TEXT,
+                     activebackground=BG2, activeforeground=GREEN,
+                     highlightthickness=0, relief="flat", bd=0)
+            m["menu"].config(font=MONO_SM, bg=BG2, fg=TEXT,
+                             activebackground=GREEN_DIM, activeforeground=GREEN)
+            m.pack(side="left", padx=(0, 6))
+        tk.Label(rate_row, text="— storing at a lower rate filters and decimates (e.g. 48000 → 8000)",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
 
         # ── File storage ──
         self._s_section(inner, "FILE STORAGE")
@@ -435,14 +556,68 @@ class VoxRecorderApp(tk.Tk):
         tk.Label(thr_row, textvariable=self.vox_threshold, width=6,
                  font=MONO_SM, bg=BG, fg=GREEN, anchor="e").pack(side="left")
 
+        at_row = row(8)
+        tk.Checkbutton(at_row, text="Auto threshold", variable=self.auto_threshold,
+                       font=MONO_SM, bg=BG, fg=TEXT, selectcolor=BG3,
+                       activebackground=BG, activeforeground=GREEN,
+                       highlightthickness=0).pack(side="left")
+        tk.Spinbox(at_row, from_=3, to=40, increment=1,
+                   textvariable=self.margin_db, width=4,
+                   font=MONO_SM, bg=BG3, fg=TEXT,
+                   insertbackground=GREEN, buttonbackground=BG2,
+                   relief="flat").pack(side="left", padx=(6, 0))
+        tk.Label(at_row, text="dB above the noise floor — follows drift, marker shows live level",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
+
+        self._s_lbl(inner, "CTCSS tones (Hz, comma separated; empty = record any carrier)")
+        tk.Entry(row(8), textvariable=self.ctcss_tones, font=MONO_SM,
+                 bg=BG3, fg=TEXT, insertbackground=GREEN,
+                 relief="flat", bd=2).pack(fill="x")
+
         self._s_lbl(inner, "Tail silence (seconds after audio drops)")
-        ts_row = row(12)
+        ts_row = row(8)
         tk.Spinbox(ts_row, from_=1, to=60, increment=0.5,
                    textvariable=self.tail_silence, width=6,
                    font=MONO_SM, bg=BG3, fg=TEXT,
                    insertbackground=GREEN, buttonbackground=BG2,
                    relief="flat").pack(side="left")
 
+        self._s_lbl(inner, "Pre-roll (seconds kept before the trigger)")
+        pr_row = row(12)
+        tk.Spinbox(pr_row, from_=0, to=10, increment=0.5,
+                   textvariable=self.preroll_secs, width=6,
+                   font=MONO_SM, bg=BG3, fg=TEXT,
+                   insertbackground=GREEN, buttonbackground=BG2,
+                   relief="flat").pack(side="left")
+
+        self._s_lbl(inner, "Detector")
+        det_row = row(4)
+        det_menu = tk.OptionMenu(det_row, self.detector_type, *DETECTORS)
+        det_menu.config(font=MONO_SM, bg=BG3, fg=TEXT,
+                        activebackground=BG2, activeforeground=GREEN,
+                        highlightthickness=0, relief="flat", bd=0)
+        det_menu["menu"].config(font=MONO_SM, bg=BG2, fg=TEXT,
+                                activebackground=GREEN_DIM, activeforeground=GREEN)
+        det_menu.pack(side="left")
+        tk.Label(det_row, text="— peak: highest sample   rms: energy of the chunk, ignores clicks",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
+
+        self._s_lbl(inner, "Close threshold (stay recording above this; 0 = same as threshold)")
+        ct_row = row(8)
+        tk.Spinbox(ct_row, from_=0, to=10000, increment=100,
+                   textvariable=self.close_threshold, width=6,
+                   font=MONO_SM, bg=BG3, fg=TEXT,
+                   insertbackground=GREEN, buttonbackground=BG2,
+                   relief="flat").pack(side="left")
+
+        self._s_lbl(inner, "Minimum open (seconds above threshold before triggering)")
+        mo_row = row(12)
+        tk.Spinbox(mo_row, from_=0, to=2, increment=0.05,
+                   textvariable=self.min_open, width=6,
+                   font=MONO_SM, bg=BG3, fg=TEXT,
+                   insertbackground=GREEN, buttonbackground=BG2,
+                   relief="flat").pack(side="left")
+
         # ── Channel / metadata ──
         self._s_section(inner, "CHANNEL & METADATA")
         self._s_lbl(inner, "Channel name (stored in JSON sidecar)")
@@ -456,7 +631,8 @@ class VoxRecorderApp(tk.Tk):
 
         self._s_lbl(inner, "Metadata script (optional executable)")
         tk.Label(inner,
-                 text="  Called before each recording. Must print JSON to stdout.\n"
+                 text="  Run in the background when a recording starts. Must print JSON\n"
+                      "  to stdout; the result is added when the recording is saved.\n"
                       '  Example output:  {"frequency": 145600000, "mode": "NFM"}',
                  font="Monospace 7", bg=BG, fg=TEXT_DIM, justify="left").pack(
                      anchor="w", padx=PX, pady=(0, 4))
@@ -467,12 +643,45 @@ class VoxRecorderApp(tk.Tk):
         tk.Button(ms_row, text="…", command=self._browse_script,
                   font=MONO_SM, bg=BG2, fg=TEXT, relief="flat",
                   padx=4, cursor="hand2", bd=0).pack(side="left", padx=(2, 0))
+        ms_srv = tk.Frame(inner, bg=BG)
+        ms_srv.pack(fill="x", padx=PX, pady=(0, 4))
+        tk.Checkbutton(ms_srv, text="Server mode", variable=self.meta_server,
+                       font=MONO_SM, bg=BG, fg=TEXT, selectcolor=BG3,
+                       activebackground=BG, activeforeground=GREEN,
+                       highlightthickness=0).pack(side="left")
+        tk.Label(ms_srv, text="— script keeps running, prints one JSON line per update",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
         tk.Button(inner, text="Test script now",
                   command=self._test_meta_script, font=MONO_SM,
                   bg=BG3, fg=TEXT, relief="flat", padx=8, pady=4,
                   cursor="hand2", bd=0, anchor="w").pack(
                       fill="x", padx=PX, pady=(0, 12))
 
+        # ── Extra channels ──
+        self._s_section(inner, "MULTI-CHANNEL")
+        self._s_lbl(inner, "Channel config file (optional JSON)")
+        tk.Label(inner,
+                 text="  Extra channels recorded alongside the main one, each with its own\n"
+                      "  device, threshold, tail, prefix, save path and metadata script.\n"
+                      '  Example:  {"channels": [{"name": "UHF", "device": 3, "threshold": 1500}]}',
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM, justify="left").pack(
+                     anchor="w", padx=PX, pady=(0, 4))
+        cf_row = row(12)
+        tk.Entry(cf_row, textvariable=self.channels_file, font=MONO_SM,
+                 bg=BG3, fg=TEXT, insertbackground=GREEN,
+                 relief="flat", bd=2).pack(side="left", fill="x", expand=True)
+        tk.Button(cf_row, text="…", command=self._browse_channels,
+                  font=MONO_SM, bg=BG2, fg=TEXT, relief="flat",
+                  padx=4, cursor="hand2", bd=0).pack(side="left", padx=(2, 0))
+        ppd_row = tk.Frame(inner, bg=BG)
+        ppd_row.pack(fill="x", padx=PX, pady=(0, 8))
+        tk.Checkbutton(ppd_row, text="Process per device", variable=self.process_per_device,
+                       font=MONO_SM, bg=BG, fg=TEXT, selectcolor=BG3,
+                       activebackground=BG, activeforeground=GREEN,
+                       highlightthickness=0).pack(side="left")
+        tk.Label(ppd_row, text="— each device in its own worker process, restarted if it dies",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
+
         # ── Audio processing ──
         self._s_section(inner, "AUDIO PROCESSING")
         for var, txt, detail in [
@@ -489,6 +698,18 @@ class VoxRecorderApp(tk.Tk):
             tk.Label(r, text=f"— {detail}", font="Monospace 7",
                      bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
 
+        self._s_lbl(inner, "Output format")
+        fmt_row = row(8)
+        fmt_menu = tk.OptionMenu(fmt_row, self.output_format, *FORMATS)
+        fmt_menu.config(font=MONO_SM, bg=BG3, fg=TEXT,
+                        activebackground=BG2, activeforeground=GREEN,
+                        highlightthickness=0, relief="flat", bd=0)
+        fmt_menu["menu"].config(font=MONO_SM, bg=BG2, fg=TEXT,
+                                activebackground=GREEN_DIM, activeforeground=GREEN)
+        fmt_menu.pack(side="left")
+        tk.Label(fmt_row, text="— flac: lossless, needs 'flac'   opus: small, needs 'opusenc'",
+                 font="Monospace 7", bg=BG, fg=TEXT_DIM).pack(side="left", padx=(4, 0))
+
         tk.Frame(inner, bg=BG, height=16).pack()
 
     def _s_section(self, parent, title):
@@ -578,6 +799,12 @@ class VoxRecorderApp(tk.Tk):
         if f:
             self.meta_script.set(f)
 
+    def _browse_channels(self):
+        f = filedialog.askopenfilename(
+            filetypes=[("JSON", "*.json"), ("All", "*")])
+        if f:
+            self.channels_file.set(f)
+
     def _ensure_dir(self):
         p = self.save_path.get()
         try:
@@ -602,318 +829,167 @@ class VoxRecorderApp(tk.Tk):
                 self._ensure_dir()
             else:
                 return
+        manual = self.mode_var.get() == "manual"
+        try:
+            configs = [self._main_channel_config()]
+        except ValueError:
+            messagebox.showerror("CTCSS", f"Not a list of tones: {self.ctcss_tones.get()}")
+            return
+        if not manual and self.channels_file.get().strip():
+            try:
+                configs += load_channel_config(self.channels_file.get().strip())
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Channel config", str(e))
+                return
+        try:
+            engine, channels = self._make_engine(configs)
+        except ValueError as e:
+            messagebox.showerror("Cannot start", str(e))
+            return
+        engine.update(0, vox=not manual)
+        self._meters   = [self._vu] + self._build_strips(channels[1:])
+        self._channels = channels
+        self._engine   = engine
+
         self.stop_event.clear()
         self._start_btn.config(state="disabled")
         self._stop_btn.config(state="normal")
-        if self.mode_var.get() == "manual":
+        if manual:
             self._rec_btn.config(state="normal")
             self._log("Monitor started (manual mode).", color=GREEN)
             self._set_status("Monitoring – press REC NOW to record")
             self.vox_listening = False
             self._update_rec_ui(False)
-            target = self._monitor_loop
         else:
             self._rec_btn.config(state="disabled")
-            self._log("VOX started. Waiting for audio…", color=GREEN)
+            n = len(channels)
+            self._log(f"VOX started on {n} channel{'s' if n > 1 else ''}. Waiting for audio…",
+                      color=GREEN)
             self._set_status("Listening for audio…")
             self.vox_listening = True
             self._update_rec_ui(False)
             self._start_waiting_pulse()
-            target = self._vox_loop
-        self.audio_thread = threading.Thread(target=target, daemon=True)
+        self.audio_thread = threading.Thread(target=engine.run, args=(self.stop_event,),
+                                             daemon=True)
         self.audio_thread.start()
 
+    def _make_engine(self, configs):
+        """VoxEngine, or Supervisor with a process per device, and its channels"""
+        rate = self.capture_rate.get()
+        if self.process_per_device.get():
+            engine = Supervisor(configs, rate=rate, chunk_size=CHUNK_SIZE,
+                                callback=self.callback_capture.get(),
+                                log=self._log_core,
+                                on_state=self._on_channel_state,
+                                on_saved=self._on_channel_saved,
+                                on_stuck=self._on_stuck,
+                                stuck_timeout=STUCK_TIMEOUT)
+            return engine, engine.channels
+        channels = [VoxChannel(cfg, self._finaliser, rate, index=i,
+                               log=self._log_core,
+                               on_state=self._on_channel_state,
+                               on_saved=self._on_channel_saved)
+                    for i, cfg in enumerate(configs)]
+        engine = VoxEngine(channels, rate=rate, chunk_size=CHUNK_SIZE,
+                           callback=self.callback_capture.get(),
+                           log=self._log_core, on_stuck=self._on_stuck,
+                           stuck_timeout=STUCK_TIMEOUT)
+        return engine, channels
+
     def _stop(self):
         self.stop_event.set()
+        self._channels = []
+        self._engine   = None
+        self._vu.set_threshold(self.vox_threshold.get())
         self.vox_listening = False
         self._start_btn.config(state="normal")
         self._stop_btn.config(state="disabled")
-        self._rec_btn.config(state="disabled")
+        self._rec_btn.config(state="disabled", text="⏺  REC NOW")
+        self.manual_active = False
         self._update_rec_ui(False)
         self._log("Stopped.", color=TEXT_DIM)
         self._set_status("Ready.")
         self.recording = False
 
     def _manual_rec(self):
-        if not self.recording:
-            self.recording     = True
-            self.manual_active = True
-            self._rec_btn.config(text="■  STOP REC")
-        else:
-            self.recording     = False
-            self.manual_active = False
-            self._rec_btn.config(text="⏺  REC NOW")
+        if self._engine is None:
+            return
+        self.manual_active = not self.manual_active
+        self._engine.update(0, force=self.manual_active)
+        self._rec_btn.config(text="■  STOP REC" if self.manual_active else "⏺  REC NOW")
 
     def _on_close(self):
         self.stop_event.set()
+        if self.audio_thread is not None:
+            self.audio_thread.join(timeout=2.0)
+        self._finaliser.close()   # let queued recordings finish
         self.destroy()
 
     # ═══════════════════════════════════════════════════════════════════════════
-    # Audio – stream helper with stuck detection
+    # Audio – channel callbacks (called from the capture and finaliser threads)
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _open_stream(self):
-        import pyaudio as pa
-        fmt    = getattr(pa, FORMAT_STR)
-        p      = pa.PyAudio()
-        kwargs = dict(format=fmt, channels=1, rate=RATE,
-                      input=True, frames_per_buffer=CHUNK_SIZE)
-        dev = self._get_device_index()
-        if dev is not None:
-            kwargs["input_device_index"] = dev
-        stream = p.open(**kwargs)
-        return p, stream, fmt
-
-    def _read_chunk_with_stuck_detect(self, stream):
-        """
-        Read one chunk. Raises RuntimeError if the stream appears stuck
-        (no data returned within STUCK_TIMEOUT seconds).
-        Uses a short-timeout poll so we don't block the stop_event.
-        """
-        deadline = time.time() + STUCK_TIMEOUT
-        while time.time() < deadline:
-            if self.stop_event.is_set():
-                return None
-            avail = stream.get_read_available()
-            if avail >= CHUNK_SIZE:
-                raw = stream.read(CHUNK_SIZE, exception_on_overflow=False)
-                chunk = array('h', raw)
-                if byteorder == 'big':
-                    chunk.byteswap()
-                return chunk
-            time.sleep(0.02)
-        raise RuntimeError("Audio stream stuck – no data received")
-
-    def _push_vu(self, chunk):
-        level = min(max(chunk) / MAXIMUMVOL, 1.0)
-        try:
-            self.vu_queue.put_nowait(level)
-        except queue.Full:
-            pass
-
-    # ── VOX loop with auto-restart on stuck ────────────────────────────────────
-
-    def _vox_loop(self):
-        while not self.stop_event.is_set():
-            try:
-                p, stream, fmt = self._open_stream()
-            except Exception as e:
-                self._log(f"Audio open failed: {e}", color=RED)
-                return
-            self._log("Listening…", color=TEXT_DIM)
-            try:
-                while not self.stop_event.is_set():
-                    # Wait for VOX trigger
-                    triggered = False
-                    while not self.stop_event.is_set():
-                        chunk = self._read_chunk_with_stuck_detect(stream)
-                        if chunk is None:
-                            break
-                        self._push_vu(chunk)
-                        if max(chunk) > self.vox_threshold.get():
-                            triggered = True
-                            break
-                    if not triggered:
-                        break
-                    self._do_record_session(p, stream, fmt, chunk)
-                break   # clean exit
-            except RuntimeError as e:
-                self._log(f"⚠  {e} — restarting…", color=AMBER)
-                self._set_status("Stream stuck – restarting audio…")
-                try:
-                    stream.stop_stream(); stream.close(); p.terminate()
-                except Exception:
-                    pass
-                time.sleep(1.0)
-                # loop continues → reopen stream
-            finally:
-                try:
-                    stream.stop_stream(); stream.close(); p.terminate()
-                except Exception:
-                    pass
-
-    # ── Manual monitor loop with auto-restart on stuck ─────────────────────────
-
-    def _monitor_loop(self):
-        while not self.stop_event.is_set():
-            try:
-                p, stream, fmt = self._open_stream()
-            except Exception as e:
-                self._log(f"Audio open failed: {e}", color=RED)
-                return
-            snd_data     = array('h')
-            rec_start    = 0
-            wav_filename = ""
-            wf           = None
-            try:
-                while not self.stop_event.is_set():
-                    chunk = self._read_chunk_with_stuck_detect(stream)
-                    if chunk is None:
-                        break
-                    self._push_vu(chunk)
-
-                    if not self.manual_active and wf is not None:
-                        wf.close(); wf = None
-                        self._finalise(p, fmt, snd_data, wav_filename, rec_start)
-                        snd_data = array('h')
-                        self._update_rec_ui(False)
-
-                    if self.manual_active:
-                        if wf is None:
-                            rec_start    = time.time()
-                            wav_filename = self._make_filename()
-                            import pyaudio as pa2
-                            wf = wave.open(f"{wav_filename}.wav", 'wb')
-                            wf.setnchannels(1)
-                            wf.setsampwidth(p.get_sample_size(
-                                getattr(pa2, FORMAT_STR)))
-                            wf.setframerate(RATE)
-                            self._update_rec_ui(True, wav_filename)
-                            self._log(f"Manual rec: {os.path.basename(wav_filename)}.wav",
-                                      color=AMBER)
-                        snd_data.extend(chunk)
-                        wf.writeframes(chunk.tobytes())
-                break   # clean exit
-            except RuntimeError as e:
-                self._log(f"⚠  {e} — restarting…", color=AMBER)
-                self._set_status("Stream stuck – restarting audio…")
-                if wf:
-                    try: wf.close()
-                    except Exception: pass
-                    wf = None
-                try:
-                    stream.stop_stream(); stream.close(); p.terminate()
-                except Exception:
-                    pass
-                time.sleep(1.0)
-            finally:
-                if wf:
-                    try: wf.close()
-                    except Exception: pass
-                try:
-                    stream.stop_stream(); stream.close(); p.terminate()
-                except Exception:
-                    pass
-
-    def _do_record_session(self, p, stream, fmt, first_chunk):
-        snd_data     = array('h', first_chunk)
-        rec_start    = time.time()
-        last_voice   = rec_start
-        wav_filename = self._make_filename()
-        meta         = self._get_metadata()
-
-        self._update_rec_ui(True, wav_filename)
-        self._log(f"Recording: {os.path.basename(wav_filename)}.wav", color=AMBER)
-
-        tail = self.tail_silence.get()
-        while not self.stop_event.is_set():
-            chunk = self._read_chunk_with_stuck_detect(stream)
-            if chunk is None:
-                break
-            snd_data.extend(chunk)
-            self._push_vu(chunk)
-            if max(chunk) > self.vox_threshold.get():
-                last_voice = time.time()
-            if time.time() > last_voice + tail:
-                break
-
-        self._finalise(p, fmt, snd_data, wav_filename, rec_start, meta)
-        self._update_rec_ui(False)
-
-    def _finalise(self, p, fmt, snd_data, wav_filename, rec_start, meta=None):
-        if not snd_data:
-            return
-        if self.normalize_audio.get():
-            snd_data = self._normalize(snd_data)
-        if self.trim_audio.get():
-            snd_data = self._trim(snd_data)
-        if self.add_silence_pad.get():
-            snd_data = self._add_silence(snd_data, 0.5)
-
-        wav_path = f"{wav_filename}.wav"
-        import pyaudio as pa
-        with wave.open(wav_path, 'wb') as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(p.get_sample_size(getattr(pa, FORMAT_STR)))
-            wf.setframerate(RATE)
-            wf.writeframes(pack('<' + ('h' * len(snd_data)), *snd_data))
-
-        duration = time.time() - rec_start
-        if meta is None:
-            meta = {}
-        # Channel name from GUI field takes priority, then from script
-        ch = self.channel_name.get().strip()
-        if ch:
-            meta["channel_name"] = ch
-        meta.update({
-            "start_time": time.strftime('%Y-%m-%d %H:%M:%S',
-                                         time.localtime(rec_start)),
-            "end_time":   time.strftime('%Y-%m-%d %H:%M:%S'),
-            "duration_s": round(duration, 1),
-        })
-        json_path = f"{wav_filename}.json"
-        with open(json_path, 'w') as jf:
-            json.dump(meta, jf, indent=4)
-
+    def _main_channel_config(self):
+        """Channel settings of the main channel, taken from the GUI fields"""
+        return ChannelConfig(
+            name=self.channel_name.get().strip(),
+            device=self._get_device_index(),
+            threshold=self.vox_threshold.get(),
+            tail_silence=self.tail_silence.get(),
+            detector=self.detector_type.get(),
+            close_threshold=self.close_threshold.get() or None,
+            min_open=self.min_open.get(),
+            auto_threshold=self.auto_threshold.get(),
+            margin_db=self.margin_db.get(),
+            ctcss=[float(t) for t in self.ctcss_tones.get().replace(",", " ").split()] or None,
+            sample_rate=None if self.store_rate.get() == "same" else int(self.store_rate.get()),
+            prefix=self.filename_prefix.get() or "voxrecord",
+            outdir=self.save_path.get(),
+            meta_script=self.meta_script.get().strip(),
+            meta_server=self.meta_server.get(),
+            preroll=self.preroll_secs.get(),
+            normalize=self.normalize_audio.get(),
+            trim=self.trim_audio.get(),
+            pad=self.add_silence_pad.get(),
+            format=self.output_format.get())
+
+    def _on_channel_state(self, channel, active):
+        if channel.index == 0:
+            self._update_rec_ui(active, channel.filename)
+
+    def _on_channel_saved(self, channel, wav_path, duration):
         self.session_count += 1
         self.after(0, lambda: self._session_label.config(
             text=f"Sessions: {self.session_count}"))
-        self._log(f"Saved: {os.path.basename(wav_path)} ({duration:.1f}s)", color=GREEN)
-        self._log(f"Meta:  {os.path.basename(json_path)}", color=TEXT_DIM)
         self._set_status(f"Last: {os.path.basename(wav_path)}")
 
+    def _on_stuck(self, device, error):
+        self._set_status("Stream stuck – restarting audio…")
+
+    def _log_core(self, msg):
+        """Log a message from voxcore, coloured like the GUI's own messages"""
+        if "Recording:" in msg or msg.startswith("⚠"):
+            color = AMBER
+        elif "Saved:" in msg:
+            color = GREEN
+        elif "failed" in msg or "error" in msg.lower():
+            color = RED
+        else:
+            color = TEXT_DIM
+        self._log(msg, color=color)
+
     # ═══════════════════════════════════════════════════════════════════════════
     # Helpers
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _make_filename(self):
-        prefix = self.filename_prefix.get() or "voxrecord"
-        ts     = time.strftime("%Y%m%d%H%M%S")
-        uid    = uuid.uuid4().hex[:6]
-        return os.path.join(self.save_path.get(), f"{prefix}-{ts}-{uid}")
-
     def _get_metadata(self):
-        script = self.meta_script.get().strip()
-        if not script:
-            return {}
+        """Run the metadata script once and wait for its output."""
+        source = MetadataSource(self.meta_script.get().strip(),
+                                log=lambda m: self._log(m, color=RED))
         try:
-            result = subprocess.run(
-                [script], capture_output=True, text=True, timeout=5)
-            raw = result.stdout.strip()
-            if raw:
-                return json.loads(raw)
-        except Exception as e:
-            self._log(f"Metadata script error: {e}", color=RED)
-        return {}
-
-    def _normalize(self, snd_data):
-        mx = max(abs(i) for i in snd_data)
-        if mx == 0:
-            return snd_data
-        t = float(MAXIMUMVOL) / mx
-        return array('h', [int(min(MAXIMUMVOL, max(-MAXIMUMVOL, i * t)))
-                            for i in snd_data])
-
-    def _trim(self, snd_data):
-        thr = self.vox_threshold.get()
-        def _trim_one(d):
-            started = False
-            r = array('h')
-            for i in d:
-                if not started and abs(i) > thr:
-                    started = True
-                if started:
-                    r.append(i)
-            return r
-        snd_data = _trim_one(snd_data)
-        snd_data.reverse()
-        snd_data = _trim_one(snd_data)
-        snd_data.reverse()
-        return snd_data
-
-    def _add_silence(self, snd_data, secs):
-        silence = array('h', [0] * int(secs * RATE))
-        return silence + snd_data + silence
+            return source.get()
+        finally:
+            source.close()
 
     def _update_rec_ui(self, active, filename=""):
         self.recording = active
@@ -980,12 +1056,19 @@ class VoxRecorderApp(tk.Tk):
 
     def _start_vu_updater(self):
         def _loop():
-            try:
-                level = self.vu_queue.get_nowait()
-                self._apply_vu_level(level)
-            except queue.Empty:
-                if self._last_vu_level > 0:
-                    self._apply_vu_level(max(0, self._last_vu_level - 0.05))
+            channels = self._channels
+            if channels:
+                for ch, meter in zip(channels, self._meters):
+                    if meter.threshold != ch.threshold:
+                        meter.set_threshold(ch.threshold)   # moves with the noise floor in auto mode
+                    meter.apply_level(ch.level, ch.recording, ch.peak)
+                lost = total_losses(channels)
+                if lost != self._lost:
+                    self._lost = lost
+                    self._lost_label.config(text=f"Lost: {lost[0]} smp / {lost[1]} ovf",
+                                            fg=AMBER if any(lost) else TEXT_DIM)
+            elif self._vu.level > 0:
+                self._vu.apply_level(max(0, self._vu.level - 0.05), False)
             self.after(40, _loop)
         self.after(40, _loop)
 